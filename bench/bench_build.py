@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# bench_build.py - benchmarks of the build pipeline (make_db)
+# on synthetic KSJ files (gen_ksj.py); runs offline.
+# Each (size, db_type) is built in a fresh process from scratch,
+# and the wall time, the peak RSS during the stage (of the process and
+# the total of the workers; sampled from /proc, or the peaks so far
+# without /proc) and the output size of each stage are reported:
+# - parse: GML -> geometry stores
+# - kml: geometry stores -> KML files (--kml)
+# - index: polygon index, roots and their schedule
+# - records: subdivision, resolution and compaction (workers)
+# - json, cdb, fs, bin: record files -> DB
+# Usage:
+#   python3 -m bench.bench_build [-s small,medium] [-t json,cdb,fs,bin]
+#     [-n n_geohash] [-w work_dir] [-o results.json] [--kml]
+
+import sys
+import os
+import json
+import getopt
+import shutil
+import tempfile
+import platform
+import contextlib
+import queue as queue_module
+import multiprocessing as mp
+from time import time
+from .gen_ksj import generate
+
+DB_TYPES = ['json', 'cdb', 'fs', 'bin']
+
+# size -> (n_cols, n_rows, n_points)
+SIZES = {
+    'small': (4, 4, 6),
+    'medium': (8, 8, 12),
+    'large': (16, 16, 24)
+}
+
+# run_make_db(args, queue)
+#   make_db() in a fresh process (so that the peak RSS is of this build).
+def run_make_db(args, queue):
+    from src.make_db import make_db
+    (ksj_file, db_type, build_dir, n_geohash, kml, log_file) = args
+    stats = []
+    with open(log_file, 'w') as fp, contextlib.redirect_stdout(fp):
+        make_db([ksj_file], db_type, build_dir, n_geohash, kml, stats=stats)
+    queue.put(stats)
+    return
+
+# bench_build(ksj_file, db_type, work_dir, n_geohash, kml)
+#   -> (total_time, [stats of each stage,...])
+def bench_build(ksj_file, db_type, work_dir, n_geohash=7, kml=False):
+    build_dir = os.path.join(work_dir, 'build')
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    log_file = os.path.join(work_dir, 'build-%s.log' % db_type)
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    t0 = time()
+    process = ctx.Process(target=run_make_db, args=(
+        (ksj_file, db_type, build_dir, n_geohash, kml, log_file), queue))
+    process.start()
+    # the child puts nothing if make_db() fails.
+    stats = None
+    while stats is None:
+        try:
+            stats = queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive():
+                break
+    process.join()
+    total_time = time() - t0
+    if stats is None or process.exitcode != 0:
+        raise RuntimeError('make_db failed (see %s)' % log_file)
+    return (total_time, stats)
+
+# format_stats(stats) -> lines
+def format_stats(stats):
+    lines = ['  %-8s %9s %10s %10s %12s' % (
+        'stage', 'wall(s)', 'rss(MB)', 'rss_w(MB)', 'output(KB)')]
+    for s in stats:
+        lines.append('  %-8s %9.3f %10.1f %10.1f %12.1f' % (
+            s['stage'], s['wall_time'], s['peak_rss'] / 1e6,
+            s['peak_rss_children'] / 1e6, s['output_size'] / 1e3))
+    return lines
+
+# main()
+def main(argv):
+    def usage():
+        print('Usage: python3 -m bench.bench_build'
+            ' [-s small,medium] [-t json,cdb,fs,bin] [-n n_geohash]'
+            ' [-w work_dir] [-o results.json] [--kml]')
+        return -1
+    sizes = ['small', 'medium']
+    db_types = DB_TYPES
+    n_geohash = 7
+    work_dir = None
+    output = None
+    kml = False
+    try:
+        (options, args) = getopt.getopt(argv, 's:t:n:w:o:', ['kml'])
+        for (opt, val) in options:
+            if opt == '-s':
+                sizes = val.split(',')
+            elif opt == '-t':
+                db_types = val.split(',')
+            elif opt == '-n':
+                n_geohash = int(val)
+            elif opt == '-w':
+                work_dir = val
+            elif opt == '-o':
+                output = val
+            elif opt == '--kml':
+                kml = True
+    except getopt.error as err:
+        print(err)
+        return usage()
+    for size in sizes:
+        if size not in SIZES:
+            print('unknown size: %s' % size)
+            return usage()
+    for db_type in db_types:
+        if db_type not in DB_TYPES:
+            print('unknown db_type: %s' % db_type)
+            return usage()
+    tmp_dir = None
+    if work_dir is None:
+        work_dir = tmp_dir = tempfile.mkdtemp(prefix='rg-ksj-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': mp.cpu_count(),
+        'n_geohash': n_geohash,
+        'runs': []
+    }
+    try:
+        for size in sizes:
+            (n_cols, n_rows, n_points) = SIZES[size]
+            ksj_file = os.path.join(work_dir, 'ksj-%s.xml' % size)
+            n_areas = generate(ksj_file, n_cols, n_rows, n_points)
+            for db_type in db_types:
+                (total_time, stats) = bench_build(
+                    ksj_file, db_type, work_dir, n_geohash, kml)
+                print('%s (%d areas, %d bytes) %s: %.3f sec' % (
+                    size, n_areas, os.path.getsize(ksj_file),
+                    db_type, total_time))
+                print('\n'.join(format_stats(stats)))
+                results['runs'].append({
+                    'size': size,
+                    'n_areas': n_areas,
+                    'input_size': os.path.getsize(ksj_file),
+                    'db_type': db_type,
+                    'total_time': total_time,
+                    'stages': stats
+                })
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    if output is not None:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print('Written: %s' % output)
+    return
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
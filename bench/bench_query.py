@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# bench_query.py - benchmarks of the query latency of the DB backends.
+# A DB of each backend is built from a synthetic KSJ file (gen_ksj.py),
+# and the lookups of random points inside the bounds of the DB
+# (uniform, and clustered around a few centers) are measured:
+# - single: get_area() of a point (p50/p99 latency per point)
+# - batch: get_areas() of batch_size points (p50/p99 latency per batch)
+# - cold: the first pass on a freshly opened geocoder
+#         (shards and pages are loaded, and the LRU cache is empty)
+# - warm: the second pass of the same points on the same geocoder.
+# (the OS page cache is not dropped; the DB files were just written.)
+# Usage:
+#   python3 make.py bench [--json, --cdb, --fs, --bin] ...
+#   python3 -m bench.bench_query [-t json,cdb,fs,bin] [-n n_geohash]
+#     [-c cache_size] [-b batch_size] [-s size] [-o results.json] [n_points]
+
+import sys
+import os
+import json
+import getopt
+import random
+import shutil
+import tempfile
+import platform
+import contextlib
+from glob import glob
+from time import perf_counter
+from .gen_ksj import generate
+from .bench_build import SIZES, DB_TYPES
+
+# the LRU cache size of the geocoders (also of `make.py bench`).
+DEFAULT_CACHE_SIZE = 4096
+
+# build_db(ksj_file, db_type, build_dir, n_geohash) -> paths to open
+def build_db(ksj_file, db_type, build_dir, n_geohash):
+    from src.make_db import make_db
+    log_file = build_dir + '.log'
+    with open(log_file, 'w') as fp, contextlib.redirect_stdout(fp):
+        make_db([ksj_file], db_type, build_dir, n_geohash)
+    if db_type == 'json':
+        return (os.path.join(build_dir, 'geohash2areacode.json'),
+            os.path.join(build_dir, 'areacode2name.json'))
+    elif db_type == 'cdb':
+        return (glob(os.path.join(build_dir, 'geohash2areacode.cdb*'))[0],
+            os.path.join(build_dir, 'areacode2name.cdb'))
+    elif db_type == 'fs':
+        return (os.path.join(build_dir, 'geohash2areacode'),
+            os.path.join(build_dir, 'areacode2name'))
+    elif db_type == 'bin':
+        return (os.path.join(build_dir, 'geohash2areacode.bin'),)
+    raise ValueError(db_type)
+
+# open_db(db_type, paths, n_chars)
+def open_db(db_type, paths, n_chars):
+    from src.query_db import open_json_db, open_cdb, open_fs_db, open_bin_db
+    open_db_func = {
+        'json': open_json_db,
+        'cdb': open_cdb,
+        'fs': open_fs_db,
+        'bin': open_bin_db
+    }[db_type]
+    return open_db_func(*paths, n_chars=n_chars)
+
+# get_db_bounds(build_dir) -> (minlat, minlng, maxlat, maxlng)
+#   the bounds of the geohashes in the record files.
+def get_db_bounds(build_dir):
+    from src.records import read_records_many
+    from src.geohash import decode_to_bounds
+    record_files = glob(
+        os.path.join(build_dir, 'records', '**', '*.rec'), recursive=True)
+    bounds = [
+        decode_to_bounds(geohash)
+        for (geohash, _) in read_records_many(record_files)]
+    return (
+        min(b[0] for b in bounds), min(b[1] for b in bounds),
+        max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+# make_workloads(bounds, n_points, seed) -> {name: [(lat, lng),...]}
+#   uniform: uniformly in the bounds.
+#   clustered: around 16 centers (sigma: 1% of the bounds).
+def make_workloads(bounds, n_points, seed=0):
+    (minlat, minlng, maxlat, maxlng) = bounds
+    r = random.Random(seed)
+    uniform = [
+        (r.uniform(minlat, maxlat), r.uniform(minlng, maxlng))
+        for _ in range(n_points)]
+    centers = [
+        (r.uniform(minlat, maxlat), r.uniform(minlng, maxlng))
+        for _ in range(16)]
+    (sigma_lat, sigma_lng) = ((maxlat - minlat) / 100, (maxlng - minlng) / 100)
+    clustered = []
+    for _ in range(n_points):
+        (lat, lng) = r.choice(centers)
+        clustered.append((
+            min(max(r.gauss(lat, sigma_lat), minlat), maxlat),
+            min(max(r.gauss(lng, sigma_lng), minlng), maxlng)))
+    return {'uniform': uniform, 'clustered': clustered}
+
+# percentile(sorted_values, q)
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# get_result(latencies, n_points, elapsed, n_found) -> result (dict)
+def get_result(latencies, n_points, elapsed, n_found):
+    latencies = sorted(latencies)
+    return {
+        'n_points': n_points,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'throughput': n_points / elapsed,
+        'found': n_found / n_points
+    }
+
+# bench_single(geocoder, points) -> result
+def bench_single(geocoder, points):
+    latencies = []
+    n_found = 0
+    t0 = perf_counter()
+    for (lat, lng) in points:
+        t = perf_counter()
+        area = geocoder.get_area(lat, lng)
+        latencies.append(perf_counter() - t)
+        if area is not None:
+            n_found += 1
+    return get_result(latencies, len(points), perf_counter() - t0, n_found)
+
+# bench_batch(geocoder, points, batch_size) -> result
+def bench_batch(geocoder, points, batch_size):
+    import numpy as np
+    lats = np.array([lat for (lat, _) in points])
+    lngs = np.array([lng for (_, lng) in points])
+    latencies = []
+    n_found = 0
+    t0 = perf_counter()
+    for i in range(0, len(points), batch_size):
+        t = perf_counter()
+        areas = geocoder.get_areas(lats[i:i+batch_size], lngs[i:i+batch_size])
+        latencies.append(perf_counter() - t)
+        n_found += sum(1 for area in areas if area is not None)
+    return get_result(latencies, len(points), perf_counter() - t0, n_found)
+
+# bench_db(db_type, paths, n_chars, workloads, cache_size, batch_size)
+#   -> [result,...]
+def bench_db(db_type, paths, n_chars, workloads, cache_size, batch_size):
+    results = []
+    for (workload, points) in sorted(workloads.items()):
+        for mode in ('single', 'batch'):
+            t0 = perf_counter()
+            geocoder = open_db(db_type, paths, n_chars)
+            geocoder.set_cache_size(cache_size)
+            open_time = perf_counter() - t0
+            for state in ('cold', 'warm'):
+                stats0 = geocoder.get_cache_stats()
+                if mode == 'single':
+                    result = bench_single(geocoder, points)
+                else:
+                    result = bench_batch(geocoder, points, batch_size)
+                result.update({
+                    'workload': workload,
+                    'mode': mode,
+                    'state': state,
+                    'open_time': open_time
+                })
+                if mode == 'batch':
+                    result['batch_size'] = batch_size
+                stats = geocoder.get_cache_stats()
+                if stats is not None:
+                    # of this pass.
+                    result['cache_hits'] = stats['hits'] - stats0['hits']
+                    result['cache_misses'] = (
+                        stats['misses'] - stats0['misses'])
+                results.append(result)
+    return results
+
+# get_db_size(paths) -> bytes
+def get_db_size(paths):
+    from src.make_db import get_output_size
+    return get_output_size(paths)
+
+# bench_query(db_types, n_geohash, n_points, ...) -> results (dict)
+def bench_query(db_types=DB_TYPES, n_geohash=7, n_points=10000,
+    cache_size=DEFAULT_CACHE_SIZE, batch_size=1000, size='small',
+    work_dir=None):
+    tmp_dir = None
+    if work_dir is None:
+        work_dir = tmp_dir = tempfile.mkdtemp(prefix='rg-ksj-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'size': size,
+        'n_geohash': n_geohash,
+        'n_points': n_points,
+        'cache_size': cache_size,
+        'runs': []
+    }
+    print('size=%s, n_geohash=%d, n_points=%d, cache_size=%d,'
+        ' batch_size=%d' % (size, n_geohash, n_points, cache_size, batch_size))
+    try:
+        (n_cols, n_rows, n_edge_points) = SIZES[size]
+        ksj_file = os.path.join(work_dir, 'ksj-%s.xml' % size)
+        results['n_areas'] = generate(ksj_file, n_cols, n_rows, n_edge_points)
+        workloads = None
+        for db_type in db_types:
+            print('Building a %s DB...' % db_type)
+            build_dir = os.path.join(work_dir, db_type)
+            paths = build_db(ksj_file, db_type, build_dir, n_geohash)
+            if workloads is None:
+                workloads = make_workloads(get_db_bounds(build_dir), n_points)
+            print('Querying the %s DB...' % db_type)
+            run = {
+                'db_type': db_type,
+                'db_size': get_db_size(paths),
+                'results': bench_db(db_type, paths, n_geohash, workloads,
+                    cache_size, batch_size)
+            }
+            print('\n'.join(format_run(run)))
+            results['runs'].append(run)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    return results
+
+# format_run(run) -> lines
+def format_run(run):
+    lines = ['%s (%d bytes)' % (run['db_type'], run['db_size'])]
+    lines.append('  %-10s %-7s %-5s %10s %10s %12s %6s' % (
+        'workload', 'mode', 'state', 'p50(us)', 'p99(us)', 'points/s',
+        'found'))
+    for r in run['results']:
+        lines.append('  %-10s %-7s %-5s %10.1f %10.1f %12.0f %6.3f' % (
+            r['workload'], r['mode'], r['state'], r['p50'] * 1e6,
+            r['p99'] * 1e6, r['throughput'], r['found']))
+    return lines
+
+# main()
+def main(argv):
+    def usage():
+        print('Usage: python3 -m bench.bench_query'
+            ' [-t json,cdb,fs,bin] [-n n_geohash] [-c cache_size]'
+            ' [-b batch_size] [-s size] [-o results.json] [n_points]')
+        return -1
+    db_types = DB_TYPES
+    n_geohash = 7
+    cache_size = DEFAULT_CACHE_SIZE
+    batch_size = 1000
+    size = 'small'
+    output = None
+    try:
+        (options, args) = getopt.getopt(argv, 't:n:c:b:s:o:')
+        for (opt, val) in options:
+            if opt == '-t':
+                db_types = val.split(',')
+            elif opt == '-n':
+                n_geohash = int(val)
+            elif opt == '-c':
+                cache_size = int(val)
+            elif opt == '-b':
+                batch_size = int(val)
+            elif opt == '-s':
+                size = val
+            elif opt == '-o':
+                output = val
+    except getopt.error as err:
+        print(err)
+        return usage()
+    if size not in SIZES or not set(db_types) <= set(DB_TYPES):
+        return usage()
+    n_points = int(args[0]) if 0 < len(args) else 10000
+    results = bench_query(db_types, n_geohash, n_points, cache_size,
+        batch_size, size)
+    if output is not None:
+        write_results(results, output)
+    return
+
+# write_results(results, output)
+def write_results(results, output):
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print('Written: %s' % output)
+    return
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# gen_ksj.py - synthetic KSJ (N03) GML files for benchmarks.
+# A grid of n_cols * n_rows municipalities (with jagged boundaries
+# shared by neighbors), where
+# - every 4th municipality (in both directions) has an enclave
+#   (a hole filled by another municipality), and
+# - every 5th municipality has an island (a multi-polygon).
+# Usage:
+#   python3 -m bench.gen_ksj output.xml [n_cols [n_rows [n_points]]]
+
+import sys
+import random
+
+HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<ksj:Dataset xmlns:gml="http://www.opengis.net/gml/3.2"'
+    ' xmlns:ksj="http://nlftp.mlit.go.jp/ksj/schemas/ksj-app"'
+    ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    ' gml:id="N03Dataset">')
+FOOTER = '</ksj:Dataset>'
+
+CURVE = (
+    '<gml:Curve gml:id="%s"><gml:segments><gml:LineStringSegment>'
+    '<gml:posList>\n%s\n</gml:posList>'
+    '</gml:LineStringSegment></gml:segments></gml:Curve>')
+RING = '<gml:Ring><gml:curveMember xlink:href="#%s"/></gml:Ring>'
+SURFACE = (
+    '<gml:Surface gml:id="%s"><gml:patches><gml:PolygonPatch>'
+    '<gml:exterior>%s</gml:exterior>%s'
+    '</gml:PolygonPatch></gml:patches></gml:Surface>')
+BOUNDARY = (
+    '<ksj:AdministrativeBoundary gml:id="%s">'
+    '<ksj:bounds xlink:href="#%s"/>'
+    '<ksj:prefectureName>%s</ksj:prefectureName>'
+    '<ksj:subPrefectureName/><ksj:countyName/>'
+    '<ksj:cityName>%s</ksj:cityName>'
+    '<ksj:administrativeAreaCode>%s</ksj:administrativeAreaCode>'
+    '</ksj:AdministrativeBoundary>')
+
+# KSJWriter
+class KSJWriter(object):
+
+    # KSJWriter()
+    def __init__(self):
+        self.curves = []
+        self.surfaces = []
+        self.boundaries = []
+        return
+
+    # add_curve([(lat, lng),...]) -> curve_id
+    #   the ring is closed here.
+    def add_curve(self, points):
+        curve_id = 'cv%d_1' % (len(self.curves) + 1)
+        points = list(points) + [points[0]]
+        self.curves.append(CURVE % (curve_id, '\n'.join(
+            '%.6f %.6f' % point for point in points)))
+        return curve_id
+
+    # add_surface(exterior_id, [interior_id,...]) -> surface_id
+    def add_surface(self, exterior_id, interior_ids=()):
+        surface_id = 'sf%d' % (len(self.surfaces) + 1)
+        interiors = ''.join(
+            '<gml:interior>%s</gml:interior>' % (RING % curve_id)
+            for curve_id in interior_ids)
+        self.surfaces.append(
+            SURFACE % (surface_id, RING % exterior_id, interiors))
+        return surface_id
+
+    # add_boundary(surface_id, area_code, pref_name, city_name)
+    def add_boundary(self, surface_id, area_code, pref_name, city_name):
+        boundary_id = 'ab%d' % (len(self.boundaries) + 1)
+        self.boundaries.append(BOUNDARY % (
+            boundary_id, surface_id, pref_name, city_name, area_code))
+        return
+
+    # write(path)
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(HEADER + '\n')
+            for lines in (self.curves, self.surfaces, self.boundaries):
+                fp.write('\n'.join(lines) + '\n')
+            fp.write(FOOTER + '\n')
+        return
+
+# generate(path, n_cols, n_rows, n_points, seed, ...) -> n_areas
+#   n_points: the number of points of each side of a municipality.
+#   size: the size of a municipality in degrees.
+def generate(path, n_cols=4, n_rows=4, n_points=6, seed=0,
+    lat0=35.5, lng0=139.0, size=0.1):
+    r = random.Random(seed)
+    # jittered grid vertices (the outer ones are not moved).
+    vertices = [
+        [(lat0 + i * size + (
+            r.uniform(-0.2, 0.2) * size if 0 < i < n_rows else 0),
+          lng0 + j * size + (
+            r.uniform(-0.2, 0.2) * size if 0 < j < n_cols else 0))
+         for j in range(n_cols + 1)]
+        for i in range(n_rows + 1)]
+    # jagged edges shared by neighbors.
+    edges = {}
+    # get_edge()
+    def get_edge(a, b):
+        key = (min(a, b), max(a, b))
+        if key not in edges:
+            (lat_a, lng_a) = vertices[key[0][0]][key[0][1]]
+            (lat_b, lng_b) = vertices[key[1][0]][key[1][1]]
+            points = []
+            for t in range(1, n_points):
+                f = t / n_points
+                points.append((
+                    lat_a + (lat_b - lat_a) * f +
+                    r.uniform(-0.03, 0.03) * size,
+                    lng_a + (lng_b - lng_a) * f +
+                    r.uniform(-0.03, 0.03) * size))
+            edges[key] = points
+        points = edges[key]
+        return points if key == (a, b) else points[::-1]
+    writer = KSJWriter()
+    pref_name = '東京都'
+    n_areas = 0
+    for i in range(n_rows):
+        for j in range(n_cols):
+            n_areas += 1
+            area_code = '13%03d' % n_areas
+            corners = [(i, j), (i, j + 1), (i + 1, j + 1), (i + 1, j)]
+            ring = []
+            for (k, a) in enumerate(corners):
+                ring.append(vertices[a[0]][a[1]])
+                ring.extend(get_edge(a, corners[(k + 1) % 4]))
+            interior_ids = []
+            if i % 4 == 1 and j % 4 == 1:
+                # enclave
+                (lat_a, lng_a) = vertices[i][j]
+                (lat_b, lng_b) = vertices[i + 1][j + 1]
+                (lat, lng) = ((lat_a + lat_b) / 2, (lng_a + lng_b) / 2)
+                d = size / 6
+                hole_id = writer.add_curve([
+                    (lat - d, lng - d), (lat - d, lng + d),
+                    (lat + d, lng + d), (lat + d, lng - d)])
+                interior_ids.append(hole_id)
+                n_areas += 1
+                writer.add_boundary(writer.add_surface(hole_id),
+                    '13%03d' % n_areas, pref_name, '飛地%d' % n_areas)
+            surface_id = writer.add_surface(
+                writer.add_curve(ring), interior_ids)
+            writer.add_boundary(
+                surface_id, area_code, pref_name, '市%s' % area_code)
+            if j == n_cols - 1 and i % 5 == 0:
+                # island
+                (lat, lng) = (lat0 + (i + 0.3) * size, lng0 + (j + 1.5) * size)
+                d = size / 3
+                surface_id = writer.add_surface(writer.add_curve([
+                    (lat, lng), (lat, lng + d),
+                    (lat + d, lng + d), (lat + d, lng)]))
+                writer.add_boundary(
+                    surface_id, area_code, pref_name, '市%s' % area_code)
+    writer.write(path)
+    return n_areas
+
+# main()
+def main(args):
+    if len(args) < 1:
+        print('Usage: python3 -m bench.gen_ksj'
+            ' output.xml [n_cols [n_rows [n_points]]]')
+        return -1
+    path = args[0]
+    n_cols = int(args[1]) if 1 < len(args) else 4
+    n_rows = int(args[2]) if 2 < len(args) else n_cols
+    n_points = int(args[3]) if 3 < len(args) else 6
+    n_areas = generate(path, n_cols, n_rows, n_points)
+    print('%s: %d areas' % (path, n_areas))
+    return
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,6 +4,9 @@
 # - build
 # - clean
 # - test
+# - geocode
+# - serve
+# - bench
 
 import getopt
 from glob import glob
@@ -19,18 +22,29 @@ dist_dir = os.path.join('.', 'dist')
 geohash2areacode_dir = 'geohash2areacode'
 geohash2areacode_json = 'geohash2areacode.json'
 geohash2areacode_cdb = 'geohash2areacode.cdb'
+geohash2areacode_cdb64 = 'geohash2areacode.cdb64'
+geohash2areacode_bin = 'geohash2areacode.bin'
+geohash2areacode_levels = 'geohash2areacode.levels.json'
+geohash2areacode_spec = 'geohash2areacode.spec.json'
+geohash2areacode_boundary = 'geohash2areacode.boundary'
 areacode2name_dir = 'areacode2name'
 areacode2name_cdb = 'areacode2name.cdb'
 areacode2name_json = 'areacode2name.json'
 
 # build():
-def build(ksj_files, db_type, n_geohash):
+def build(ksj_files, db_type, n_geohash, kml=False, split_depth=4,
+    incremental=False, level_depth=0, hybrid=False):
     # clean
     print('Cleaning...')
-    clean()
+    if incremental:
+        # reuse build_dir.
+        clean_dist()
+    else:
+        clean()
     # build
     print('Ready.')
-    make_db(ksj_files, db_type, build_dir, n_geohash)
+    make_db(ksj_files, db_type, build_dir, n_geohash, kml, split_depth,
+        incremental, level_depth, hybrid)
     # dist
     print('Making distributables...')
     os.makedirs(dist_dir)
@@ -40,6 +54,9 @@ def build(ksj_files, db_type, n_geohash):
     shutil.copyfile(
         os.path.join(src_dir, 'geohash.py'),
         os.path.join(dist_dir, 'geohash.py'))
+    shutil.copyfile(
+        os.path.join(src_dir, 'server.py'),
+        os.path.join(dist_dir, 'server.py'))
     if db_type == 'json':
         shutil.move(
             os.path.join(build_dir, geohash2areacode_json),
@@ -51,9 +68,12 @@ def build(ksj_files, db_type, n_geohash):
         shutil.copyfile(
             os.path.join(src_dir, 'cdb.py'),
             os.path.join(dist_dir, 'cdb.py'))
-        shutil.move(
-            os.path.join(build_dir, geohash2areacode_cdb),
-            os.path.join(dist_dir, geohash2areacode_cdb))
+        # cdb64 is made instead of cdb for large DBs.
+        for fname in (geohash2areacode_cdb, geohash2areacode_cdb64):
+            if os.path.isfile(os.path.join(build_dir, fname)):
+                shutil.move(
+                    os.path.join(build_dir, fname),
+                    os.path.join(dist_dir, fname))
         shutil.move(
             os.path.join(build_dir, areacode2name_cdb),
             os.path.join(dist_dir, areacode2name_cdb))
@@ -64,6 +84,34 @@ def build(ksj_files, db_type, n_geohash):
         shutil.move(
             os.path.join(build_dir, areacode2name_dir),
             os.path.join(dist_dir, areacode2name_dir))
+    elif db_type == 'bin':
+        shutil.copyfile(
+            os.path.join(src_dir, 'bindb.py'),
+            os.path.join(dist_dir, 'bindb.py'))
+        shutil.move(
+            os.path.join(build_dir, geohash2areacode_bin),
+            os.path.join(dist_dir, geohash2areacode_bin))
+    shutil.move(
+        os.path.join(build_dir, geohash2areacode_spec),
+        os.path.join(dist_dir, geohash2areacode_spec))
+    if os.path.isfile(os.path.join(build_dir, geohash2areacode_levels)):
+        shutil.move(
+            os.path.join(build_dir, geohash2areacode_levels),
+            os.path.join(dist_dir, geohash2areacode_levels))
+    if hybrid:
+        shutil.copyfile(
+            os.path.join(src_dir, 'boundary.py'),
+            os.path.join(dist_dir, 'boundary.py'))
+        shutil.move(
+            os.path.join(build_dir, geohash2areacode_boundary),
+            os.path.join(dist_dir, geohash2areacode_boundary))
+    return
+
+# clean_dist():
+def clean_dist():
+    # rm dist
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
     return
 
 # clean():
@@ -72,8 +120,7 @@ def clean():
     if os.path.isdir(build_dir):
         shutil.rmtree(build_dir)
     # rm dist
-    if os.path.isdir(dist_dir):
-        shutil.rmtree(dist_dir)
+    clean_dist()
     # rm *.pyc
     for dpath in glob('./src/**/__pycache__', recursive=True):
         shutil.rmtree(dpath)
@@ -81,15 +128,82 @@ def clean():
         os.remove(fpath)
     return
 
+# open_dist_db():
+#   -> the geocoder of the database in dist_dir (or None).
+def open_dist_db():
+    if os.path.isfile(os.path.join(dist_dir, geohash2areacode_json)):
+        from dist.query_db import open_json_db as open_db
+        paths = (
+            os.path.join(dist_dir, geohash2areacode_json),
+            os.path.join(dist_dir, areacode2name_json))
+    elif os.path.isfile(os.path.join(dist_dir, geohash2areacode_cdb)):
+        from dist.query_db import open_cdb as open_db
+        paths = (
+            os.path.join(dist_dir, geohash2areacode_cdb),
+            os.path.join(dist_dir, areacode2name_cdb))
+    elif os.path.isfile(os.path.join(dist_dir, geohash2areacode_cdb64)):
+        from dist.query_db import open_cdb as open_db
+        paths = (
+            os.path.join(dist_dir, geohash2areacode_cdb64),
+            os.path.join(dist_dir, areacode2name_cdb))
+    elif os.path.isfile(os.path.join(dist_dir, geohash2areacode_bin)):
+        from dist.query_db import open_bin_db as open_db
+        paths = (os.path.join(dist_dir, geohash2areacode_bin),)
+    elif os.path.isdir(os.path.join(dist_dir, geohash2areacode_dir)):
+        from dist.query_db import open_fs_db as open_db
+        paths = (
+            os.path.join(dist_dir, geohash2areacode_dir),
+            os.path.join(dist_dir, areacode2name_dir))
+    else:
+        return None
+    return open_db(*paths)
+
+# geocode():
+def geocode(src_csv, dst_csv):
+    geocoder = open_dist_db()
+    if geocoder is None:
+        print('No database found. Run `build` first.')
+        return -1
+    from dist.query_db import geocode_csv
+    n_rows = geocode_csv(geocoder, src_csv, dst_csv)
+    print('Finished: %d rows -> %s' % (n_rows, dst_csv))
+    return
+
+# serve():
+#   n_workers processes are forked if 1 < n_workers.
+def serve(host, port, cache_size, n_workers=1):
+    geocoder = open_dist_db()
+    if geocoder is None:
+        print('No database found. Run `build` first.')
+        return -1
+    from dist.server import serve as serve_forever, serve_prefork
+    geocoder.set_cache_size(cache_size)
+    if 1 < n_workers:
+        serve_prefork(geocoder, host, port, n_workers)
+    else:
+        serve_forever(geocoder, host, port)
+    return
+
 # main():
 def main(argv):
     def help(target=None):
         cmd = '\npython3 make.py'
         usage = 'Usage:'
         if target is None or target == 'build':
-            usage += cmd + ' build [--json, --cdb, --fs] [-n $(n_geohash)] ksj_files'
+            usage += cmd + ' build [--json, --cdb, --fs, --bin]'
+            usage += ' [-n $(n_geohash)] [-d $(split_depth)] [-i]'
+            usage += ' [-l $(level_depth)] [--hybrid] [--kml] ksj_files'
         if target is None or target == 'test':
-            usage += cmd + ' test lat lng'
+            usage += cmd + ' test [-c $(cache_size)] lat lng [lat lng...]'
+        if target is None or target == 'geocode':
+            usage += cmd + ' geocode input.csv output.csv'
+        if target is None or target == 'serve':
+            usage += cmd + ' serve [-p $(port)] [--host $(host)]'
+            usage += ' [-c $(cache_size)] [-w $(n_workers)]'
+        if target is None or target == 'bench':
+            usage += cmd + ' bench [--json, --cdb, --fs, --bin]'
+            usage += ' [-n $(n_geohash)] [-c $(cache_size)]'
+            usage += ' [-o $(results_json)] [n_points]'
         if target is None or target == 'clean':
             usage += cmd + ' clean'
         return usage
@@ -98,52 +212,127 @@ def main(argv):
         return -1
     cmd = argv[0]
     db_type = 'json'
+    db_types = []
     n_geohash = 7
+    kml = False
+    split_depth = 4
+    incremental = False
+    level_depth = 0
+    hybrid = False
+    cache_size = None
+    host = '127.0.0.1'
+    port = 8080
+    n_workers = 1
+    output = None
     try:
         (options, args) = getopt.getopt(argv[1:],
-            'n:', ['json', 'cdb', 'fs'])
+            'n:d:il:c:p:w:o:', ['json', 'cdb', 'fs', 'bin', 'kml',
+            'incremental', 'hybrid', 'host='])
         for (opt, val) in options:
             if opt == '-n':
                 n_geohash = int(val)
+            elif opt == '-d':
+                split_depth = int(val)
+            elif opt in ('-i', '--incremental'):
+                incremental = True
+            elif opt == '-l':
+                level_depth = int(val)
+            elif opt == '-c':
+                cache_size = int(val)
+            elif opt == '-p':
+                port = int(val)
+            elif opt == '-w':
+                n_workers = int(val)
+            elif opt == '--host':
+                host = val
+            elif opt == '-o':
+                output = val
             elif opt == '--json':
                 db_type = 'json'
+                db_types.append(db_type)
             elif opt == '--cdb':
                 db_type = 'cdb'
+                db_types.append(db_type)
             elif opt == '--fs':
                 db_type = 'fs'
+                db_types.append(db_type)
+            elif opt == '--bin':
+                db_type = 'bin'
+                db_types.append(db_type)
+            elif opt == '--kml':
+                kml = True
+            elif opt == '--hybrid':
+                hybrid = True
     except getopt.error as err:
         print(err)
         print(help())
         return -1
+    if cache_size is None and cmd != 'bench':
+        # the cache is off unless -c is given (bench has its own default).
+        cache_size = 0
     if cmd == 'build':
         if len(args) < 1:
             print(help(cmd))
             return -1
-        build(args, db_type, n_geohash)
+        build(args, db_type, n_geohash, kml, split_depth, incremental,
+            level_depth, hybrid)
     elif cmd == 'test':
-        # TODO: add db spec(n_chars)
-        gh2ac = None
-        ac2an = None
+        paths = None
         if os.path.isfile(os.path.join(dist_dir, geohash2areacode_json)):
             from dist.query_db import get_area_from_json_db as get_area
-            gh2ac = os.path.join(dist_dir, geohash2areacode_json)
-            ac2an = os.path.join(dist_dir, areacode2name_json)
+            paths = (
+                os.path.join(dist_dir, geohash2areacode_json),
+                os.path.join(dist_dir, areacode2name_json))
         elif os.path.isfile(os.path.join(dist_dir, geohash2areacode_cdb)):
             from dist.query_db import get_area_from_cdb as get_area
-            gh2ac = os.path.join(dist_dir, geohash2areacode_cdb)
-            ac2an = os.path.join(dist_dir, areacode2name_cdb)
+            paths = (
+                os.path.join(dist_dir, geohash2areacode_cdb),
+                os.path.join(dist_dir, areacode2name_cdb))
+        elif os.path.isfile(os.path.join(dist_dir, geohash2areacode_cdb64)):
+            from dist.query_db import get_area_from_cdb as get_area
+            paths = (
+                os.path.join(dist_dir, geohash2areacode_cdb64),
+                os.path.join(dist_dir, areacode2name_cdb))
+        elif os.path.isfile(os.path.join(dist_dir, geohash2areacode_bin)):
+            from dist.query_db import get_area_from_bin_db as get_area
+            paths = (os.path.join(dist_dir, geohash2areacode_bin),)
         elif os.path.isdir(os.path.join(dist_dir, geohash2areacode_dir)):
             from dist.query_db import get_area_from_fs_db as get_area
-            gh2ac = os.path.join(dist_dir, geohash2areacode_dir)
-            ac2an = os.path.join(dist_dir, areacode2name_dir)
+            paths = (
+                os.path.join(dist_dir, geohash2areacode_dir),
+                os.path.join(dist_dir, areacode2name_dir))
         else:
             print('No database found. Run `build` first.')
             return -1
         if len(args) < 2:
             print(help(cmd))
             return -1
-        (lat, lng) = [float(v) for v in args[:2]]
-        print(get_area(lat, lng, gh2ac, ac2an))
+        from dist.query_db import set_cache_size, get_cache_stats
+        set_cache_size(cache_size)
+        for i in range(0, len(args) - 1, 2):
+            (lat, lng) = [float(v) for v in args[i:i+2]]
+            print(get_area(lat, lng, *paths))
+        if 0 < cache_size:
+            for stats in get_cache_stats():
+                print('cache: %s' % ', '.join(
+                    '%s=%d' % (k, v) for (k, v) in stats.items()))
+    elif cmd == 'geocode':
+        if len(args) < 2:
+            print(help(cmd))
+            return -1
+        return geocode(args[0], args[1])
+    elif cmd == 'serve':
+        return serve(host, port, cache_size, n_workers)
+    elif cmd == 'bench':
+        from bench.bench_query import bench_query, write_results, DB_TYPES
+        from bench.bench_query import DEFAULT_CACHE_SIZE
+        if cache_size is None:
+            cache_size = DEFAULT_CACHE_SIZE
+        n_points = int(args[0]) if 0 < len(args) else 10000
+        results = bench_query(db_types or DB_TYPES, n_geohash, n_points,
+            cache_size)
+        if output is not None:
+            write_results(results, output)
     elif cmd == 'clean':
         clean()
     else:   # including cmd == 'help'.
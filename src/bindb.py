@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# bindb.py - compact sorted binary DB (geohash -> area code, area name)
+# [Format] (little endian)
+# - header: magic(8s), version(I), n_strings(I), n_keys(Q), pos_strings(Q)
+# - keys: uint64 * n_keys (sorted)
+#   geohash (up to 12 chars) is left-aligned in the upper 60 bits
+#   and its length is stored in the lower 4 bits,
+#   so that a geohash sorts just before its sub-geohashes.
+# - values: uint16 * n_keys (index of the area code in the string table)
+# - strings (at pos_strings): uint32 * (n_strings * 2 + 1) offsets
+#   followed by utf-8 strings [area_code, area_name, area_code, ...].
+# Any geohash is looked up by one binary search over all its prefixes.
+
+import sys
+import os
+import mmap
+from bisect import bisect_right, bisect_left
+from struct import pack, unpack_from, calcsize
+from array import array
+from .geohash import geohash2int, int2geohash
+
+MAGIC = b'RGKSJBIN'
+VERSION = 1
+HEADER = '<8sIIQQ'
+MAX_CHARS = 12
+
+# geohash2key(): e.g. 'xn7' -> 0b11101_10100_00111_00000..._0011
+def geohash2key(geohash):
+    assert 0 < len(geohash) <= MAX_CHARS
+    n = geohash2int(geohash) << (5 * (MAX_CHARS - len(geohash)))
+    return (n << 4) | len(geohash)
+
+# key2geohash(): the inverse of geohash2key().
+def key2geohash(key):
+    n_chars = key & 0b1111
+    return int2geohash(key >> (4 + 5 * (MAX_CHARS - n_chars)), n_chars)
+
+# BinDBWriter
+class BinDBWriter(object):
+
+    # BinDBWriter(name, areacode2name)
+    def __init__(self, name, areacode2name):
+        self.fn = name
+        self.fntmp = name + '.tmp'
+        self._strings = []
+        self._areacode2index = {}
+        for (area_code, area_name) in areacode2name.items():
+            self._add_area_code(area_code, area_name)
+        self._keys = array('Q')
+        self._values = array('H')
+        return
+
+    # _add_area_code(area_code, area_name) -> index
+    def _add_area_code(self, area_code, area_name=''):
+        i = self._areacode2index.get(area_code)
+        if i is None:
+            i = len(self._strings) // 2
+            assert i < 0x10000
+            self._areacode2index[area_code] = i
+            self._strings += [area_code, area_name]
+        return i
+
+    # add(geohash, area_code)
+    def add(self, k, v):
+        assert isinstance(k, str)
+        assert isinstance(v, str)
+        self._keys.append(geohash2key(k))
+        self._values.append(self._add_area_code(v))
+        return self
+
+    # finish()
+    def finish(self):
+        import numpy as np
+        keys = np.frombuffer(self._keys, dtype=np.uint64)
+        values = np.frombuffer(self._values, dtype=np.uint16)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order].astype('<u8')
+        values = values[order].astype('<u2')
+        # - No duplication of geohash (one geohash -> one area code).
+        assert np.all(keys[1:] != keys[:-1])
+        strings = [s.encode() for s in self._strings]
+        offsets = array('I', [0])
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        pos_strings = calcsize(HEADER) + len(keys) * 10
+        pos_strings += (-pos_strings) % 8
+        with open(self.fntmp, 'wb') as fp:
+            fp.write(pack(HEADER, MAGIC, VERSION,
+                len(strings) // 2, len(keys), pos_strings))
+            fp.write(keys.tobytes())
+            fp.write(values.tobytes())
+            fp.write(b'\0' * (pos_strings - fp.tell()))
+            fp.write(np.array(offsets, dtype='<u4').tobytes())
+            fp.write(b''.join(strings))
+        os.rename(self.fntmp, self.fn)
+        return
+
+# BinDBReader
+#   mmaps a bin DB file once and looks up geohashes without any syscall.
+class BinDBReader(object):
+
+    # BinDBReader(name)
+    def __init__(self, name):
+        self.fn = name
+        with open(name, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, n_strings, n_keys, pos_strings) = \
+            unpack_from(HEADER, self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a bin db: %s' % name)
+        pos_keys = calcsize(HEADER)
+        pos_values = pos_keys + n_keys * 8
+        if sys.byteorder == 'little':
+            mv = memoryview(self._mm)
+            self.keys = mv[pos_keys:pos_values].cast('Q')
+            self.values = mv[pos_values:pos_values + n_keys * 2].cast('H')
+        else:
+            self.keys = array('Q', self._mm[pos_keys:pos_values])
+            self.values = array('H', self._mm[
+                pos_values:pos_values + n_keys * 2])
+            self.keys.byteswap()
+            self.values.byteswap()
+        # string table (small enough to keep in memory).
+        offsets = unpack_from('<%dI' % (n_strings * 2 + 1),
+            self._mm, pos_strings)
+        pos = pos_strings + len(offsets) * 4
+        strings = [
+            self._mm[pos + offsets[i]:pos + offsets[i+1]].decode()
+            for i in range(n_strings * 2)]
+        self.area_codes = strings[0::2]
+        self.ac2an = dict(zip(strings[0::2], strings[1::2]))
+        return
+
+    # __len__()
+    def __len__(self):
+        return len(self.keys)
+
+    # get(geohash, default)
+    def get(self, k, default=None):
+        if not (0 < len(k) <= MAX_CHARS):
+            return default
+        key = geohash2key(k)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.area_codes[self.values[i]]
+        return default
+
+    # find(geohash) -> (geohash_prefix, area_code) or None
+    #   the longest prefix of geohash in the DB.
+    def find(self, geohash):
+        n_chars = min(len(geohash), MAX_CHARS)
+        if n_chars == 0:
+            return None
+        geohash = geohash[:n_chars]
+        # the largest key <= geohash is the longest prefix of geohash
+        # if it is a prefix of geohash.
+        key = geohash2key(geohash) | 0b1111
+        i = bisect_right(self.keys, key) - 1
+        if 0 <= i:
+            prefix = key2geohash(self.keys[i])
+            if geohash.startswith(prefix):
+                return (prefix, self.area_codes[self.values[i]])
+        # otherwise (its prefix has other sub-geohashes),
+        # look up its prefixes one by one.
+        gh1 = geohash
+        while 0 < len(gh1):
+            area_code = self.get(gh1)
+            if area_code is not None:
+                return (gh1, area_code)
+            gh1 = gh1[:-1]
+        return None
+
+    # items()
+    def items(self):
+        for (key, i) in zip(self.keys, self.values):
+            yield (key2geohash(key), self.area_codes[i])
+        return
+
+    # close()
+    def close(self):
+        if isinstance(self.keys, memoryview):
+            self.keys.release()
+            self.values.release()
+        self._mm.close()
+        return
+
+# bindb_make(name, areacode2name)
+def bindb_make(name, areacode2name):
+    return BinDBWriter(name, areacode2name)
+
+# bindb_open(name)
+def bindb_open(name):
+    return BinDBReader(name)
+
+# test()
+def test():
+    writer = bindb_make('mydb.bin', {'13101': 'Tokyo Chiyoda'})
+    d = {
+        'xn7': '13101',
+        'xn76': '13102',
+        'xn76u': '13101',
+        'xn77b': '13103',
+        'w': '47000'
+    }
+    for (k, v) in d.items():
+        writer.add(k, v)
+    writer.finish()
+    reader = bindb_open('mydb.bin')
+    assert len(reader) == len(d)
+    assert dict(reader.items()) == d
+    for (k, v) in d.items():
+        assert reader.get(k) == v
+    assert reader.get('xn7u') is None
+    assert reader.find('xn76urx') == ('xn76u', '13101')
+    assert reader.find('xn76bbb') == ('xn76', '13102')
+    assert reader.find('xn7zzzz') == ('xn7', '13101')
+    assert reader.find('xn77c00') == ('xn7', '13101')
+    assert reader.find('wzzzzzz') == ('w', '47000')
+    assert reader.find('z000000') is None
+    assert reader.find('0000000') is None
+    assert reader.ac2an['13101'] == 'Tokyo Chiyoda'
+    assert reader.ac2an['13102'] == ''
+    reader.close()
+    os.remove('mydb.bin')
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# boundary.py - boundary cells (geohash -> clipped polygons of areas)
+# for the exact point-in-polygon test at query time (hybrid mode).
+# [Format] (little endian)
+# - header: magic(8s), version(I), n_chars(I), n_cells(Q), pos_index(Q)
+# - cells: a packed cell at each offset:
+#   n_parts(H), and n_parts * (
+#     len(area_code)(B), area_code, n_rings(H),
+#     n_rings * (n_points(I), (lat, lng) * n_points (float64)))
+# - index (at pos_index): geohashes (uint64 * n_cells, sorted)
+#   followed by offsets of their cells (uint64 * n_cells)
+# All boundary cells have the same length (n_chars).
+
+import sys
+import os
+import mmap
+from bisect import bisect_left
+from struct import pack, unpack_from, calcsize
+from array import array
+from .geohash import geohash2int
+
+# the area code of a boundary cell in the DB is
+# BOUNDARY_PREFIX + the default area code of the cell.
+BOUNDARY_PREFIX = '@'
+
+MAGIC = b'RGKSJBND'
+VERSION = 1
+HEADER = '<8sIIQQ'
+
+# pack_cell([(area_code, [ring,...]),...]) -> bytes
+#   ring: [(lat, lng),...]
+def pack_cell(parts):
+    data = [pack('<H', len(parts))]
+    for (area_code, rings) in parts:
+        area_code = area_code.encode()
+        data.append(pack('<B', len(area_code)))
+        data.append(area_code)
+        data.append(pack('<H', len(rings)))
+        for ring in rings:
+            coords = array('d', [v for point in ring for v in point])
+            if sys.byteorder != 'little':
+                coords.byteswap()
+            data.append(pack('<I', len(coords) // 2))
+            data.append(coords.tobytes())
+    return b''.join(data)
+
+# unpack_cell(data, pos) -> [(area_code, [coords,...]),...]
+#   coords: (lat, lng, lat, lng,...)
+def unpack_cell(data, pos):
+    parts = []
+    (n_parts,) = unpack_from('<H', data, pos)
+    pos += 2
+    for _ in range(n_parts):
+        (n,) = unpack_from('<B', data, pos)
+        pos += 1
+        area_code = bytes(data[pos:pos+n]).decode()
+        pos += n
+        (n_rings,) = unpack_from('<H', data, pos)
+        pos += 2
+        rings = []
+        for _ in range(n_rings):
+            (n_points,) = unpack_from('<I', data, pos)
+            pos += 4
+            rings.append(unpack_from('<%dd' % (n_points * 2), data, pos))
+            pos += n_points * 16
+        parts.append((area_code, rings))
+    return parts
+
+# contains(rings, lat, lng)
+#   ray casting (even-odd rule) over all the rings
+#   (exteriors and interiors) of an area.
+def contains(rings, lat, lng):
+    inside = False
+    for coords in rings:
+        n = len(coords)
+        (lat0, lng0) = (coords[n-2], coords[n-1])
+        for i in range(0, n, 2):
+            (lat1, lng1) = (coords[i], coords[i+1])
+            if (lng1 > lng) != (lng0 > lng):
+                if lat < (lat0 - lat1) * (lng - lng1) / (lng0 - lng1) + lat1:
+                    inside = not inside
+            (lat0, lng0) = (lat1, lng1)
+    return inside
+
+# BoundaryWriter
+#   cells are written sequentially, and the index is written at last.
+class BoundaryWriter(object):
+
+    # BoundaryWriter(name, n_chars)
+    def __init__(self, name, n_chars):
+        self.fn = name
+        self.fntmp = name + '.tmp'
+        self.n_chars = n_chars
+        self.numentries = 0
+        self._fp = open(self.fntmp, 'wb', buffering=1 << 20)
+        self._pos = calcsize(HEADER)
+        self._fp.write(b'\0' * self._pos)
+        self._keys = array('Q')
+        self._offsets = array('Q')
+        return
+
+    # add(geohash, [(area_code, [ring,...]),...])
+    def add(self, geohash, parts):
+        assert len(geohash) == self.n_chars
+        return self.add_packed(geohash2int(geohash), pack_cell(parts))
+
+    # add_packed(key, packed_cell)
+    def add_packed(self, key, data):
+        self._keys.append(key)
+        self._offsets.append(self._pos)
+        self._fp.write(data)
+        self._pos += len(data)
+        self.numentries += 1
+        return self
+
+    # finish()
+    def finish(self):
+        order = sorted(range(len(self._keys)), key=self._keys.__getitem__)
+        keys = array('Q', [self._keys[i] for i in order])
+        offsets = array('Q', [self._offsets[i] for i in order])
+        # - No duplication of geohash.
+        assert all(keys[i] < keys[i+1] for i in range(len(keys) - 1))
+        pos_index = self._pos + (-self._pos) % 8
+        self._fp.write(b'\0' * (pos_index - self._pos))
+        if sys.byteorder != 'little':
+            keys.byteswap()
+            offsets.byteswap()
+        self._fp.write(keys.tobytes())
+        self._fp.write(offsets.tobytes())
+        self._fp.seek(0)
+        self._fp.write(pack(HEADER, MAGIC, VERSION,
+            self.n_chars, len(keys), pos_index))
+        self._fp.close()
+        os.rename(self.fntmp, self.fn)
+        return
+
+# BoundaryReader
+class BoundaryReader(object):
+
+    # BoundaryReader(name)
+    def __init__(self, name):
+        self.fn = name
+        with open(name, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.n_chars, n_cells, pos_index) = \
+            unpack_from(HEADER, self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a boundary file: %s' % name)
+        self._pos_index = pos_index
+        pos_offsets = pos_index + n_cells * 8
+        self._keys = array('Q', self._mm[pos_index:pos_offsets])
+        self._offsets = array('Q', self._mm[
+            pos_offsets:pos_offsets + n_cells * 8])
+        if sys.byteorder != 'little':
+            self._keys.byteswap()
+            self._offsets.byteswap()
+        return
+
+    # __len__()
+    def __len__(self):
+        return len(self._keys)
+
+    # get(geohash) -> [(area_code, [coords,...]),...] or None
+    def get(self, geohash):
+        if len(geohash) != self.n_chars:
+            return None
+        key = geohash2int(geohash)
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+        return unpack_cell(self._mm, self._offsets[i])
+
+    # locate(geohash, lat, lng) -> area_code or None
+    #   the area of the boundary cell geohash which contains (lat, lng).
+    def locate(self, geohash, lat, lng):
+        for (area_code, rings) in self.get(geohash) or []:
+            if contains(rings, lat, lng):
+                return area_code
+        return None
+
+    # items_packed() -> [(key, packed_cell),...]
+    def items_packed(self):
+        ends = sorted(self._offsets) + [self._pos_index]
+        pos2end = dict(zip(ends[:-1], ends[1:]))
+        for (key, pos) in zip(self._keys, self._offsets):
+            yield (key, self._mm[pos:pos2end[pos]])
+        return
+
+    # close()
+    def close(self):
+        self._mm.close()
+        return
+
+# boundary_make(name, n_chars)
+def boundary_make(name, n_chars):
+    return BoundaryWriter(name, n_chars)
+
+# boundary_open(name)
+def boundary_open(name):
+    return BoundaryReader(name)
+
+# test()
+def test():
+    # xn76u is split by lat = 35.68 into 13101 (south) and 13102 (north).
+    square = [(35.0, 139.0), (35.68, 139.0), (35.68, 140.0), (35.0, 140.0)]
+    hole = [(35.5, 139.7), (35.6, 139.7), (35.6, 139.8), (35.5, 139.8)]
+    north = [(35.68, 139.0), (36.0, 139.0), (36.0, 140.0), (35.68, 140.0)]
+    writer = boundary_make('mybnd.bnd', 5)
+    writer.add('xn76u', [('13101', [square, hole]), ('13102', [north])])
+    writer.add('xn76g', [('13103', [north])])
+    writer.finish()
+    # merge
+    reader = boundary_open('mybnd.bnd')
+    writer = boundary_make('mybnd2.bnd', 5)
+    for (key, data) in reader.items_packed():
+        writer.add_packed(key, data)
+    writer.finish()
+    reader.close()
+    reader = boundary_open('mybnd2.bnd')
+    assert len(reader) == 2
+    assert reader.locate('xn76u', 35.67, 139.77) == '13101'
+    assert reader.locate('xn76u', 35.69, 139.77) == '13102'
+    assert reader.locate('xn76u', 35.55, 139.75) is None
+    assert reader.locate('xn76g', 35.69, 139.77) == '13103'
+    assert reader.locate('xn76v', 35.69, 139.77) is None
+    assert reader.get('xn76') is None
+    reader.close()
+    os.remove('mybnd.bnd')
+    os.remove('mybnd2.bnd')
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
@@ -4,29 +4,81 @@
 #  https://github.com/euske/pytcdb
 #  by Yusuke Shinyama
 #
+# cdb64: a variant of cdb with 64-bit hashes and positions
+#  (header: (pos_bucket, ncells) * 256 as uint64, cells: (hash, pos) as uint64)
+#  for files larger than 4GB. Records are the same as cdb.
 
 import sys
 import os
-from functools import reduce
-from struct import pack, unpack
+import mmap
+from struct import pack, unpack, unpack_from, calcsize
 from array import array
+from itertools import accumulate, chain
 
 # cdbhash(key)
 def cdbhash(s):
-    return reduce(lambda h,c: ((h*33) ^ c) & 0xffffffff, s, 5381)
+    h = 5381
+    for c in s:
+        h = (((h << 5) + h) ^ c) & 0xffffffff
+    return h
+
+# cdbhash64(key)
+def cdbhash64(s):
+    h = 5381
+    for c in s:
+        h = (((h << 5) + h) ^ c) & 0xffffffffffffffff
+    return h
+
+# the maximum size of a cdb file (positions are 32-bit).
+CDB_MAX_SIZE = 1 << 32
+
+# cdbhash_many(keys, bits) -> [hash,...]
+#   keys of the same length are hashed at once with numpy (if available).
+def cdbhash_many(keys, bits=32):
+    try:
+        import numpy as np
+    except ImportError:
+        hash_func = cdbhash64 if bits == 64 else cdbhash
+        return [hash_func(k) for k in keys]
+    mask = np.uint64((1 << bits) - 1)
+    hashes = np.full(len(keys), 5381, dtype=np.uint64)
+    lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+    for klen in np.unique(lengths).tolist():
+        if klen == 0:
+            continue
+        indexes = np.nonzero(lengths == klen)[0]
+        a = np.frombuffer(
+            b''.join([keys[i] for i in indexes.tolist()]), dtype=np.uint8)
+        a = a.reshape(-1, klen).astype(np.uint64)
+        h = hashes[indexes]
+        for j in range(klen):
+            h = ((h * np.uint64(33)) ^ a[:, j]) & mask
+        hashes[indexes] = h
+    return hashes.tolist()
 
 # CDBWriter
+#   records are written sequentially through a large buffer
+#   (the header is written at last).
 class CDBWriter(object):
 
+    BUFFER_SIZE = 1 << 20
+    CHUNK_SIZE = 1 << 16
+    # 'I': uint32 (cdb), 'Q': uint64 (cdb64)
+    TYPECODE = 'I'
+    HASH_BITS = 32
+
     # CDBWriter(cdbname)
     def __init__(self, cdbname):
         self.fn = cdbname
         self.fntmp = cdbname+'.tmp'
         self.numentries = 0
-        self._fp = open(self.fntmp, 'wb')
-        self._pos = 2048   # sizeof((h,p))*256
-        self._size = 2048
-        self._bucket = [array('I') for _ in range(256)]
+        self._hash = cdbhash64 if self.HASH_BITS == 64 else cdbhash
+        self._hashes = array(self.TYPECODE)
+        self._positions = array(self.TYPECODE)
+        # sizeof((h,p))*256
+        self._pos = self._positions.itemsize * 2 * 256
+        self._fp = open(self.fntmp, 'wb', buffering=self.BUFFER_SIZE)
+        self._fp.write(b'\0' * self._pos)
         return
 
     # add(key, val)
@@ -36,56 +88,93 @@ class CDBWriter(object):
         k = k.encode()
         v = v.encode()
         (klen, vlen) = (len(k), len(v))
-        self._fp.seek(self._pos)
-        self._fp.write(pack('<II', klen, vlen))
-        self._fp.write(k)
-        self._fp.write(v)
-        h = cdbhash(k)
-        b = self._bucket[h % 256]
-        b.append(h)
-        b.append(self._pos)
+        self._fp.write(pack('<II', klen, vlen) + k + v)
+        self._hashes.append(self._hash(k))
+        self._positions.append(self._pos)
         # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
-        size = 8+klen+vlen
-        self._pos += size
-        self._size += size+16 # bucket
+        self._pos += 8+klen+vlen
         self.numentries += 1
         return self
 
+    # add_many(iterable of (key, val))
+    def add_many(self, items):
+        chunk = []
+        for kv in items:
+            chunk.append(kv)
+            if self.CHUNK_SIZE <= len(chunk):
+                self._add_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._add_chunk(chunk)
+        return self
+
+    # _add_chunk([(key, val),...])
+    def _add_chunk(self, items):
+        keys = [k.encode() for (k, _) in items]
+        vals = [v.encode() for (_, v) in items]
+        lens = [pack('<II', len(k), len(v)) for (k, v) in zip(keys, vals)]
+        self._fp.write(b''.join(chain.from_iterable(zip(lens, keys, vals))))
+        # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
+        sizes = [8+len(k)+len(v) for (k, v) in zip(keys, vals)]
+        self._positions.extend(accumulate([self._pos] + sizes[:-1]))
+        self._hashes.extend(cdbhash_many(keys, self.HASH_BITS))
+        self._pos += sum(sizes)
+        self.numentries += len(keys)
+        return
+
     # finish()
     def finish(self):
-        self._fp.seek(self._pos)
         pos_hash = self._pos
+        # group entries by bucket (in the order they were added).
+        hashes = self._hashes
+        positions = self._positions
+        cellsize = positions.itemsize * 2
+        buckets = [[] for _ in range(256)]
+        for (i, h) in enumerate(hashes):
+            buckets[h & 0xff].append(i)
         # write hashes
-        for b1 in self._bucket:
+        header = []
+        for b1 in buckets:
+            # ncells = 2 * entries.
+            ncells = len(b1)*2
+            header.append(pos_hash)
+            header.append(ncells)
+            pos_hash += ncells*cellsize
             if not b1: continue
-            blen = len(b1)
-            a = array('I', [0]*blen*2)
-            for j in range(0, blen, 2):
-                (h,p) = (b1[j],b1[j+1])
-                i = ((h >> 8) % blen)*2
+            a = array(self.TYPECODE, [0]*ncells*2)
+            for j in b1:
+                (h, p) = (hashes[j], positions[j])
+                i = ((h >> 8) % ncells)*2
                 while a[i+1]: # is cell[i] already occupied?
                     i = (i+2) % len(a)
                 a[i] = h
                 a[i+1] = p
+            if sys.byteorder != 'little':
+                a.byteswap()
             self._fp.write(a.tobytes())
-        assert self._fp.tell() == self._size
+        assert self._fp.tell() == pos_hash
         # write header
         self._fp.seek(0)
-        a = array('I')
-        for b1 in self._bucket:
-            a.append(pos_hash)
-            a.append(len(b1))
-            pos_hash += len(b1)*8
-        self._fp.write(a.tobytes())
+        self._fp.write(pack('<512%s' % self.TYPECODE, *header))
         # close
         self._fp.close()
         os.rename(self.fntmp, self.fn)
         return
 
+# CDB64Writer
+class CDB64Writer(CDBWriter):
+
+    TYPECODE = 'Q'
+    HASH_BITS = 64
+
 # cdbmake(cdbname)
 def cdbmake(cdbname):
     return CDBWriter(cdbname)
 
+# cdb64make(cdbname)
+def cdb64make(cdbname):
+    return CDB64Writer(cdbname)
+
 # cdbget(cdbname, key)
 def cdbget(cdbname, k):
     assert isinstance(k, str)
@@ -112,6 +201,96 @@ def cdbget(cdbname, k):
                     return v1.decode()
         raise KeyError
 
+# CDBReader
+#   mmaps a cdb file once and looks up keys without any syscall.
+class CDBReader(object):
+
+    TYPECODE = 'I'
+    HASH_BITS = 32
+
+    # CDBReader(cdbname)
+    def __init__(self, cdbname):
+        self.fn = cdbname
+        with open(cdbname, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._hash = cdbhash64 if self.HASH_BITS == 64 else cdbhash
+        # cell: (hash, pos)
+        self._cell = '<2%s' % self.TYPECODE
+        self._cellsize = calcsize(self._cell)
+        # header: (pos_bucket, ncells) * 256
+        self._header = unpack_from('<512%s' % self.TYPECODE, self._mm, 0)
+        return
+
+    # get(key, default)
+    def get(self, k, default=None):
+        assert isinstance(k, str)
+        k = k.encode()
+        mm = self._mm
+        (cell, cellsize) = (self._cell, self._cellsize)
+        h = self._hash(k)
+        i_header = (h % 256) * 2
+        pos_bucket = self._header[i_header]
+        ncells = self._header[i_header+1]
+        if ncells == 0: return default
+        start = (h >> 8) % ncells
+        for i in range(ncells):
+            (h1, p1) = unpack_from(
+                cell, mm, pos_bucket + ((start+i) % ncells)*cellsize)
+            if p1 == 0: return default
+            if h1 == h:
+                (klen, vlen) = unpack_from('<II', mm, p1)
+                p1 += 8
+                if mm[p1:p1+klen] == k:
+                    # return the first match.
+                    p1 += klen
+                    return mm[p1:p1+vlen].decode()
+        return default
+
+    # items()
+    #   iterate over all (key, val) in the order they were added.
+    def items(self):
+        mm = self._mm
+        pos = self._cellsize * 256
+        # records end where the first hash table begins.
+        end = self._header[0]
+        while pos < end:
+            (klen, vlen) = unpack_from('<II', mm, pos)
+            pos += 8
+            k = mm[pos:pos+klen].decode()
+            pos += klen
+            v = mm[pos:pos+vlen].decode()
+            pos += vlen
+            yield (k, v)
+        return
+
+    # __getitem__(key)
+    def __getitem__(self, k):
+        v = self.get(k)
+        if v is None: raise KeyError(k)
+        return v
+
+    # __contains__(key)
+    def __contains__(self, k):
+        return self.get(k) is not None
+
+    # close()
+    def close(self):
+        self._mm.close()
+        return
+
+# CDB64Reader
+class CDB64Reader(CDBReader):
+
+    TYPECODE = 'Q'
+    HASH_BITS = 64
+
+# cdbopen(cdbname)
+#   *.cdb64 is opened as cdb64.
+def cdbopen(cdbname):
+    if cdbname.endswith('.cdb64'):
+        return CDB64Reader(cdbname)
+    return CDBReader(cdbname)
+
 # test()
 def test():
     cdb_writer = cdbmake('mycdb.cdb')
@@ -131,6 +310,38 @@ def test():
         assert False
     except KeyError:
         pass
+    cdb_reader = cdbopen('mycdb.cdb')
+    for (k, v) in d.items():
+        assert cdb_reader.get(k) == v
+        assert cdb_reader[k] == v
+    assert cdb_reader.get('key99') is None
+    assert 'key99' not in cdb_reader
+    assert dict(cdb_reader.items()) == d
+    cdb_reader.close()
+    # add_many() makes the same file as add().
+    with open('mycdb.cdb', 'rb') as fp:
+        data = fp.read()
+    cdbmake('mycdb.cdb').add_many(d.items()).finish()
+    with open('mycdb.cdb', 'rb') as fp:
+        assert fp.read() == data
+    assert cdbhash_many([b'', b'key01', b'k']) == [
+        cdbhash(b''), cdbhash(b'key01'), cdbhash(b'k')]
+    os.remove('mycdb.cdb')
+    # cdb64
+    cdb_writer = cdb64make('mycdb.cdb64')
+    cdb_writer.add('key01', 'val01')
+    cdb_writer.add_many(list(d.items())[1:])
+    cdb_writer.finish()
+    cdb_reader = cdbopen('mycdb.cdb64')
+    assert isinstance(cdb_reader, CDB64Reader)
+    for (k, v) in d.items():
+        assert cdb_reader.get(k) == v
+    assert cdb_reader.get('key99') is None
+    assert dict(cdb_reader.items()) == d
+    cdb_reader.close()
+    os.remove('mycdb.cdb64')
+    assert cdbhash_many([b'key01'], 64) == [cdbhash64(b'key01')]
+    assert cdbhash64(b'key01' * 8) != cdbhash(b'key01' * 8)
     return
 
 if __name__ == '__main__':
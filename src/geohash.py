@@ -5,6 +5,8 @@
 # Geohash:
 # https://en.wikipedia.org/wiki/Geohash
 
+import math
+
 # midpoint()
 def midpoint(seq):
     assert(len(seq) == 2)
@@ -38,6 +40,14 @@ def bits2char(bits):
 def char2bits(char):
     return BASE32_TO_DECIMAL[char]
 
+# geohash2int()
+#   e.g. 'xn7' -> 0b11101_10100_00111
+def geohash2int(geohash):
+    n = 0
+    for char in geohash:
+        n = (n << 5) | BASE32_TO_DECIMAL[char]
+    return n
+
 # get_char()
 def get_char(i_chars, lat_lng, lat_lng_range):
     (lat, lng) = lat_lng
@@ -63,8 +73,77 @@ def get_char(i_chars, lat_lng, lat_lng_range):
                 lat_range = upper_half(lat_range)
     return (bits2char(bits), (lat_range, lng_range))
 
+# spread_bits(): 32 bits -> 64 bits (b31..b0 -> 0b31..0b0)
+SPREAD_MASKS = (
+    (16, 0x0000ffff0000ffff),
+    (8, 0x00ff00ff00ff00ff),
+    (4, 0x0f0f0f0f0f0f0f0f),
+    (2, 0x3333333333333333),
+    (1, 0x5555555555555555))
+def spread_bits(x):
+    for (shift, mask) in SPREAD_MASKS:
+        x = (x | (x << shift)) & mask
+    return x
+# squash_bits(): 64 bits -> 32 bits (the inverse of spread_bits())
+SQUASH_MASKS = (
+    (1, 0x3333333333333333),
+    (2, 0x0f0f0f0f0f0f0f0f),
+    (4, 0x00ff00ff00ff00ff),
+    (8, 0x0000ffff0000ffff),
+    (16, 0x00000000ffffffff))
+def squash_bits(x):
+    x &= 0x5555555555555555
+    for (shift, mask) in SQUASH_MASKS:
+        x = (x | (x >> shift)) & mask
+    return x
+
+# quantize(): value in [lo, lo + width] -> 32 bit integer
+#   value must be finite (nan and inf raise ValueError and OverflowError);
+#   finite values out of range are clamped.
+def quantize(value, lo, width):
+    q = int((value - lo) / width * 4294967296.0)
+    return min(max(q, 0), 4294967295)
+
+# encode_int()
+#   encode (lat, lng) to an integer geohash (n_chars * 5 bits).
+#   lat and lng are quantized to 32 bit integers
+#   whose bits are interleaved (lng first) into 64 bits.
+#   lat and lng must be finite (see quantize()).
+def encode_int(lat, lng, n_chars=11):
+    assert 0 < n_chars <= 12
+    bits = (spread_bits(quantize(lng, -180.0, 360.0)) << 1) | (
+        spread_bits(quantize(lat, -90.0, 180.0)))
+    return bits >> (64 - n_chars * 5)
+
+# decode_int()
+#   decode an integer geohash (n_chars * 5 bits) to (lat_range, lng_range).
+def decode_int(n, n_chars=11):
+    assert 0 < n_chars <= 12
+    bits = n << (64 - n_chars * 5)
+    n_lng_bits = (n_chars * 5 + 1) // 2
+    n_lat_bits = (n_chars * 5) // 2
+    i_lng = squash_bits(bits >> 1) >> (32 - n_lng_bits)
+    i_lat = squash_bits(bits) >> (32 - n_lat_bits)
+    lng_width = 360.0 / (1 << n_lng_bits)
+    lat_width = 180.0 / (1 << n_lat_bits)
+    return (
+        (i_lat * lat_width - 90.0, (i_lat + 1) * lat_width - 90.0),
+        (i_lng * lng_width - 180.0, (i_lng + 1) * lng_width - 180.0))
+
+# int2geohash()
+#   e.g. (0b11101_10100_00111, 3) -> 'xn7'
+def int2geohash(n, n_chars):
+    chars = [''] * n_chars
+    for i in range(n_chars - 1, -1, -1):
+        chars[i] = BASE32[n & 0b11111]
+        n >>= 5
+    return ''.join(chars)
+
 # encode()
 def encode(lat, lng, n_chars=11):
+    if 0 < n_chars <= 12:
+        # fast path.
+        return int2geohash(encode_int(lat, lng, n_chars), n_chars)
     chars = ''
     lat_lng_range = ((-90.0, +90.0), (-180.0, +180.0))
     for i_chars in range(n_chars):
@@ -72,108 +151,73 @@ def encode(lat, lng, n_chars=11):
         chars += char
     return chars
 
+# get_index_range()
+#   -> (i_min, i_max): indexes of the cells (1/2**n_bits of [lo, lo + width])
+#      which cover [minval, maxval].
+#   a bound on the border of two cells belongs to the inner one.
+def get_index_range(minval, maxval, lo, width, n_bits):
+    n_cells = 1 << n_bits
+    i_min = int(math.floor((minval - lo) / width * n_cells))
+    i_max = int(math.ceil((maxval - lo) / width * n_cells)) - 1
+    i_min = min(max(i_min, 0), n_cells - 1)
+    i_max = min(max(i_max, i_min), n_cells - 1)
+    return (i_min, i_max)
+
+# cover_int()
+#   -> integer geohashes (n_chars) which cover bounds, in ascending order.
+def cover_int(bounds, n_chars):
+    assert 0 < n_chars <= 12
+    (minlat, minlng, maxlat, maxlng) = bounds
+    n_lat_bits = (n_chars * 5) // 2
+    n_lng_bits = (n_chars * 5 + 1) // 2
+    (lat0, lat1) = get_index_range(minlat, maxlat, -90.0, 180.0, n_lat_bits)
+    (lng0, lng1) = get_index_range(minlng, maxlng, -180.0, 360.0, n_lng_bits)
+    # interleave the bits of lat and lng indexes (lng first).
+    shift = 64 - n_chars * 5
+    lat_bits = [
+        spread_bits(i << (32 - n_lat_bits)) >> shift
+        for i in range(lat0, lat1 + 1)]
+    lng_bits = [
+        (spread_bits(i << (32 - n_lng_bits)) << 1) >> shift
+        for i in range(lng0, lng1 + 1)]
+    return sorted(a | b for a in lat_bits for b in lng_bits)
+
+# cover()
+#   -> geohashes which cover bounds (minlat, minlng, maxlat, maxlng).
+#   - length: the length of geohashes.
+#   - max_length: if specified, the cells on the edges of bounds
+#     are split into smaller cells up to max_length (mixed precision),
+#     while the cells inside bounds are kept in length.
+def cover(bounds, length=11, max_length=None):
+    if max_length is None or max_length <= length:
+        return [int2geohash(n, length) for n in cover_int(bounds, length)]
+    (minlat, minlng, maxlat, maxlng) = bounds
+    geohashes = []
+    for n in cover_int(bounds, length):
+        ((minlat1, maxlat1), (minlng1, maxlng1)) = decode_int(n, length)
+        geohash = int2geohash(n, length)
+        if (minlat <= minlat1 and maxlat1 <= maxlat and
+            minlng <= minlng1 and maxlng1 <= maxlng):
+            geohashes.append(geohash)
+        else:
+            # the cell on the edges of bounds.
+            bounds1 = (
+                max(minlat, minlat1), max(minlng, minlng1),
+                min(maxlat, maxlat1), min(maxlng, maxlng1))
+            geohashes += [
+                geohash + geohash1[length:]
+                for geohash1 in cover(bounds1, length + 1, max_length)]
+    return geohashes
+
 # encode_to_geohashes()
-# TODO: CLEAN UP !!!
 def encode_to_geohashes(bounds, length=11):
-    (minlat, minlng, maxlat, maxlng) = bounds
-    chars = ''
-    chars0 = [(
-        '',
-        ((minlat, maxlat), (minlng, maxlng)),
-        ((-90.0, +90.0), (-180.0, +180.0)))]
-    for i_chars in range(length):
-        chars1 = []
-        for (chars, range0, range1) in chars0:
-            n_bits = 5
-            bits0 = [(0b00000, range0, range1)]
-            for i_bits in range(n_bits):
-                bits1 = []
-                for (bits, range00, range01) in bits0:
-                    (lat_range0, lng_range0) = range00
-                    (lat_range1, lng_range1) = range01
-                    (minlat0, _) = lat_range0
-                    (minlng0, _) = lng_range0
-                    if (i_chars * n_bits + i_bits) % 2 == 0:
-                        # lng
-                        mid = midpoint(lng_range1)
-                        lower = lower_half(lng_range1)
-                        upper = upper_half(lng_range1)
-                        if minlng0 < mid:
-                            if is_contained0(lng_range0, lower):
-                                bits1.append((
-                                    bits | (0b00000 >> i_bits),
-                                    range00,
-                                    (lat_range1, lower)))
-                            else:
-                                bits1.append((
-                                    bits | (0b00000 >> i_bits),
-                                    (lat_range0, (lng_range0[0], mid)),
-                                    (lat_range1, lower)))
-                                bits1.append((
-                                    bits | (0b10000 >> i_bits),
-                                    (lat_range0, (mid, lng_range0[1])),
-                                    (lat_range1, upper)))
-                        else:
-                            if is_contained0(lng_range0, upper):
-                                bits1.append((
-                                    bits | (0b10000 >> i_bits),
-                                    range00,
-                                    (lat_range1, upper)))
-                            else:
-                                bits1.append((
-                                    bits | (0b00000 >> i_bits),
-                                    (lat_range0, (lng_range0[0], mid)),
-                                    (lat_range1, lower)))
-                                bits1.append((
-                                    bits | (0b10000 >> i_bits),
-                                    (lat_range0, (mid, lng_range0[1])),
-                                    (lat_range1, upper)))
-                    else:
-                        # lat
-                        mid = midpoint(lat_range1)
-                        lower = lower_half(lat_range1)
-                        upper = upper_half(lat_range1)
-                        if minlat0 < mid:
-                            if is_contained0(lat_range0, lower):
-                                bits1.append((
-                                    bits | (0b00000 >> i_bits),
-                                    range00,
-                                    (lower, lng_range1)))
-                            else:
-                                bits1.append((
-                                    bits | (0b00000 >> i_bits),
-                                    ((lat_range0[0], mid), lng_range0),
-                                    (lower, lng_range1)))
-                                bits1.append((
-                                    bits | (0b10000 >> i_bits),
-                                    ((mid, lat_range0[1]), lng_range0),
-                                    (upper, lng_range1)))
-                        else:
-                            if is_contained0(lat_range0, upper):
-                                bits1.append((
-                                    bits | (0b10000 >> i_bits),
-                                    range00,
-                                    (upper, lng_range1)))
-                            else:
-                                bits1.append((
-                                    bits | (0b00000 >> i_bits),
-                                    ((lat_range0[0], mid), lng_range0),
-                                    (lower, lng_range1)))
-                                bits1.append((
-                                    bits | (0b10000 >> i_bits),
-                                    ((mid, lat_range0[1]), lng_range0),
-                                    (upper, lng_range1)))
-                bits0 = bits1
-            ##
-            chars1 += [
-                (chars + bits2char(bits), range00, range01)
-                for (bits, range00, range01) in bits0
-            ]
-        chars0 = chars1
-    return [chars for (chars, _, _) in chars0]
+    return cover(bounds, length)
 
 # decode()
 def decode(geohash):
+    if 0 < len(geohash) <= 12:
+        # fast path.
+        return decode_int(geohash2int(geohash), len(geohash))
     lat_range = (-90.0, +90.0)
     lng_range = (-180.0, +180.0)
     for (i_chars, char) in enumerate(geohash):
@@ -204,6 +248,12 @@ def decode_to_point(geohash):
     (lat_range, lng_range) =  decode(geohash)
     return (midpoint(lat_range), midpoint(lng_range))
 
+# decode_to_bounds()
+#   -> (minlat, minlng, maxlat, maxlng)
+def decode_to_bounds(geohash):
+    ((minlat, maxlat), (minlng, maxlng)) = decode(geohash)
+    return (minlat, minlng, maxlat, maxlng)
+
 # get_longest_geohash()
 def get_longest_geohash(lat_lng_range, n_chars=11):
     ((minlat, maxlat), (minlng, maxlng)) = lat_lng_range
@@ -227,6 +277,29 @@ def get_sub_geohashes(geohash):
         geohash + c for c in BASE32
     ]]
 
+# encode_int_array()
+#   encode numpy arrays of lat, lng to an array of integer geohashes
+#   (uint64, n_chars <= 12) at once.
+#   lat and lng are quantized to 32 bit integers
+#   whose bits are interleaved (lng first) into 64 bits.
+#   lat and lng must be finite (see quantize()).
+def encode_int_array(lats, lngs, n_chars=11):
+    import numpy as np
+    assert 0 < n_chars <= 12
+    # spread(): see spread_bits().
+    def spread(x):
+        for (shift, mask) in SPREAD_MASKS:
+            x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+        return x
+    # quantize()
+    def quantize(values, lo, width):
+        q = (np.asarray(values, dtype=np.float64) - lo) / width * 4294967296.0
+        return np.clip(q, 0, 4294967295).astype(np.uint64)
+    lat_bits = spread(quantize(lats, -90.0, 180.0))
+    lng_bits = spread(quantize(lngs, -180.0, 360.0))
+    bits = (lng_bits << np.uint64(1)) | lat_bits
+    return bits >> np.uint64(64 - n_chars * 5)
+
 if __name__ == "__main__":
     # encode
     assert(encode(24.44944, 122.93361) == 'wsr7j6vs29z')
@@ -236,13 +309,39 @@ if __name__ == "__main__":
     assert(encode(35.68123, 139.76712) == 'xn76urx61zq')
     assert(encode(35.68123, 139.76712, 1) == 'x')
     assert(encode(35.68123, 139.76712, 10) == 'xn76urx61z')
+    assert(encode(35.68123, 139.76712, 13) == 'xn76urx61zq79')
+    # encode_int, int2geohash
+    assert(int2geohash(encode_int(35.68123, 139.76712), 11) == 'xn76urx61zq')
+    assert(int2geohash(encode_int(35.68123, 139.76712, 12), 12)
+        == 'xn76urx61zq7')
     # decode
     (lat_range, lng_range) = decode('xn76urx61zq')
     assert(lat_range[0] <= 35.68123 and 35.68123 < lat_range[1])
     assert(lng_range[0] <= 139.76712 and 139.76712 < lng_range[1])
+    assert(decode('xn76urx61zq') == decode_int(geohash2int('xn76urx61zq')))
+    assert(decode('xn7') == ((35.15625, 36.5625), (139.21875, 140.625)))
     # - encode_to_geohashes
     assert(encode_to_geohashes((34.620, 136.471, 34.621, 136.472), 6)
         == ['xn1hcq'])
     assert(encode_to_geohashes((34.620, 136.471, 34.621, 136.472), 7)
         == ['xn1hcqr', 'xn1hcqx'])
+    # - cover
+    assert(cover((34.620, 136.471, 34.621, 136.472), 7)
+        == ['xn1hcqr', 'xn1hcqx'])
+    assert(cover(decode_to_bounds('xn7'), 3) == ['xn7'])
+    assert(len(cover(decode_to_bounds('xn7'), 4)) == 32)
+    geohashes = cover((35.0, 139.0, 36.0, 140.0), 4, 6)
+    assert(geohashes == sorted(geohashes))
+    assert(min(len(geohash) for geohash in geohashes) == 4)
+    assert(max(len(geohash) for geohash in geohashes) == 6)
+    # - geohash2int, encode_int_array
+    assert(geohash2int('xn7') == 0b11101_10100_00111)
+    try:
+        import numpy as np
+        lats = np.array([24.44944, 20.42527, 24.28305, 45.55722, 35.68123])
+        lngs = np.array([122.93361, 136.06972, 153.98638, 148.75222, 139.76712])
+        assert(list(encode_int_array(lats, lngs, 11)) == [
+            geohash2int(encode(lat, lng)) for (lat, lng) in zip(lats, lngs)])
+    except ImportError:
+        pass
     print('TEST: OK')
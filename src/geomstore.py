@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# geomstore.py - store of rings (sequences of (lat, lng))
+# - $(name).coords: packed float64 coordinates (lat, lng, lat, lng, ...).
+# - $(name).index: uint64 offsets (in points) of each ring.
+#   ring i consists of points [offsets[i], offsets[i+1]).
+# Rings are passed between the stages of make_db
+# through this store (memory-mapped) instead of KML files.
+
+import sys
+import os
+import mmap
+from array import array
+from itertools import chain
+
+# GeometryWriter
+class GeometryWriter(object):
+
+    # GeometryWriter(name)
+    def __init__(self, name):
+        self.fn = name
+        self._fp = open(name + '.coords', 'wb')
+        self._offsets = array('Q', [0])
+        return
+
+    # add(points) -> ring_id
+    def add(self, points):
+        a = array('d', chain.from_iterable(points))
+        assert len(a) % 2 == 0
+        self._fp.write(a.tobytes())
+        self._offsets.append(self._offsets[-1] + len(a) // 2)
+        return len(self._offsets) - 2
+
+    # finish()
+    def finish(self):
+        self._fp.close()
+        with open(self.fn + '.index', 'wb') as fp:
+            fp.write(self._offsets.tobytes())
+        return
+
+# GeometryReader
+class GeometryReader(object):
+
+    # GeometryReader(name)
+    def __init__(self, name):
+        import numpy as np
+        self.fn = name
+        self._offsets = array('Q')
+        with open(name + '.index', 'rb') as fp:
+            self._offsets.frombytes(fp.read())
+        self._coords = np.zeros((0, 2))
+        if 0 < self._offsets[-1]:
+            with open(name + '.coords', 'rb') as fp:
+                self._mm = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._coords = np.frombuffer(
+                self._mm, dtype=np.float64).reshape(-1, 2)
+        return
+
+    # __len__()
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    # get(ring_id) -> numpy array of (lat, lng) (a view of the store)
+    def get(self, ring_id):
+        return self._coords[
+            self._offsets[ring_id]:self._offsets[ring_id+1]]
+
+# geomstore_make(name)
+def geomstore_make(name):
+    return GeometryWriter(name)
+
+# geomstore_open(name)
+def geomstore_open(name):
+    return GeometryReader(name)
+
+# test()
+def test():
+    writer = geomstore_make('mygeom')
+    rings = [
+        [(35.0, 139.0), (35.0, 139.1), (35.1, 139.1), (35.0, 139.0)],
+        [],
+        [(35.01, 139.01), (35.02, 139.02), (35.01, 139.02)]
+    ]
+    for (i, ring) in enumerate(rings):
+        assert writer.add(ring) == i
+    writer.finish()
+    reader = geomstore_open('mygeom')
+    assert len(reader) == len(rings)
+    for (i, ring) in enumerate(rings):
+        assert [tuple(p) for p in reader.get(i).tolist()] == ring
+    del reader
+    os.remove('mygeom.coords')
+    os.remove('mygeom.index')
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
@@ -13,24 +13,28 @@
 #      
 
 from glob import glob
+import hashlib
 import json
 import os
 import shutil
 import sys
+import threading
 from time import time
 import multiprocessing as mp
-import re
-import sys
 import xml.etree.ElementTree as ET
-from .cdb import cdbmake
-from .geohash import BASE32, decode_to_range
-from .geohash import encode_to_geohashes, get_sub_geohashes
-from shapely.geometry import Point, Polygon
-
-## XML Namespaces used in KML.
-KML_NS = {
-    'kml': 'http://www.opengis.net/kml/2.2'
-}
+from .cdb import cdbmake, cdb64make, CDB_MAX_SIZE
+from .bindb import bindb_make
+from .records import recmake, read_records, read_records_many
+from .records import count_records
+from .boundary import boundary_make, boundary_open, BOUNDARY_PREFIX
+from .geomstore import geomstore_make, geomstore_open
+from .geohash import BASE32, decode_to_bounds
+from .geohash import cover
+from .polyindex import PolygonIndex
+from .subdivide import Subdivider, INSIDE
+from .resolve import resolve_candidates
+from shapely.geometry import Polygon
+
 ## XML Namespaces used in GML for KSJ (Kokudo Suuchi Jouho).
 KSJ_NS = {
     'gml': 'http://www.opengis.net/gml/3.2',
@@ -43,135 +47,45 @@ KSJ_NS = {
 def get_pref_code(area_code):
     return area_code[:2]
 
-# get_area_code():
-def get_area_code(fpath):
-    basename = os.path.basename(fpath)
-    return basename.split('-')[0]
-
-# get_geohash()
-#   e.g. ./build/kml-index/x/p/e/9
-PAT = re.compile(r'.*kml-index/(.+)')
-def get_geohash(dirpath):
-    # too rough...\
-    m = PAT.match(dirpath)
-    if m is not None:
-        return ''.join(m.group(1).split('/'))
-    return ''
-
-# make_point()
-def make_point(lat_lng_range):
-    ((minlat, maxlat), (minlng, maxlng)) = lat_lng_range
-    return Point((minlat + maxlat) / 2, (maxlat + maxlng) / 2)
-
-# make_polygon(): kml_file -> polygon
-def make_polygon(kml_file):
-    def parse_coords_lines(lines):
-        points = []
-        for line in lines.splitlines():
-            s = line.strip()
-            if 0 < len(s):
-                (lng, lat) = [float(v) for v in s.split(',')]
-                points.append((lat, lng))
-        return points
-    tree = ET.parse(kml_file)
-    root = tree.getroot()
-    kml_doc = root.find('kml:Document', KML_NS)
-    placemark = kml_doc.find('kml:Placemark', KML_NS)
-    kml_polygon = placemark.find('kml:Polygon', KML_NS)
-    # outerBoundary (exterios)
-    bounds = kml_polygon.find('kml:outerBoundaryIs', KML_NS)
-    ring = bounds.find('kml:LinearRing', KML_NS)
-    coords = ring.find('kml:coordinates', KML_NS)
-    outer_points = parse_coords_lines(coords.text)
-    # innerBoundary (interior)
-    inner_points = []
-    for bounds in kml_polygon.findall('kml:innerBoundaryIs', KML_NS):
-        ring = bounds.find('kml:LinearRing', KML_NS)
-        coords = ring.find('kml:coordinates', KML_NS)
-        inner_points.append(parse_coords_lines(coords.text))
-    return Polygon(outer_points, inner_points)
-
-# make_polygons(): kml_file -> [(polygon, lat_lng_range),...]
-def make_polygons(kml_file):
-    def parse_coords_lines(lines):
-        points = []
-        minlat = maxlat = minlng = maxlng = None
-        for line in lines.splitlines():
-            s = line.strip()
-            if 0 < len(s):
-                (lng, lat) = [float(v) for v in s.split(',')]
-                if minlat is None:
-                    minlat = maxlat = lat
-                    minlng = maxlng = lng
-                else:
-                    if lat < minlat: minlat = lat
-                    if maxlat < lat: maxlat = lat
-                    if lng < minlng: minlng = lng
-                    if maxlng < lng: maxlng = lng
-                points.append((lat, lng))
-        return (points, ((minlat, maxlat), (minlng, maxlng)))
-    retval = []
-    tree = ET.parse(kml_file)
-    root = tree.getroot()
-    kml_doc = root.find('kml:Document', KML_NS)
-    for placemark in kml_doc.findall('kml:Placemark', KML_NS):
-        for kml_polygon in placemark.findall('kml:Polygon', KML_NS):
-            # outerBoundary (exterios)
-            bounds = kml_polygon.find('kml:outerBoundaryIs', KML_NS)
-            ring = bounds.find('kml:LinearRing', KML_NS)
-            coords = ring.find('kml:coordinates', KML_NS)
-            (outer_points, lat_lng_range) = parse_coords_lines(coords.text)
-            # innerBoundary (interior)
-            inner_points = []
-            for bounds in kml_polygon.findall('kml:innerBoundaryIs', KML_NS):
-                ring = bounds.find('kml:LinearRing', KML_NS)
-                coords = ring.find('kml:coordinates', KML_NS)
-                inner_points.append(parse_coords_lines(coords.text)[0])
-            polygon = Polygon(outer_points, inner_points)
-            retval.append((polygon, lat_lng_range))
-    return retval
+# get_polygon_name():
+#   e.g. ('13101', 0) -> '13101-01'
+def get_polygon_name(area_code, i):
+    return '%s-%02d' % (area_code, i + 1)
+
+# parse_polygon_name():
+#   e.g. '13101-01' -> ('13101', 0)
+def parse_polygon_name(polygon_name):
+    (area_code, i) = polygon_name.split('-')
+    return (area_code, int(i) - 1)
 
-# find_nearest_polygon():
-#   find the nearest polygon to geohash area
-#   from polygons defined in kml_files.
-def find_nearest_polygon(geohash, kml_files):
-    # make_polygon()
-    def make_polygon(lat_lng_range):
-        ((minlat, maxlat), (minlng, maxlng)) = lat_lng_range
-        return Polygon([
-            (minlat, minlng),
-            (minlat, maxlng),
-            (maxlat, maxlng),
-            (maxlat, minlng),
-            (minlat, minlng)
-        ])
-
-    assert 0 < len(kml_files)
-    lat_lng_range = decode_to_range(geohash)
-    polygon0 = make_polygon(lat_lng_range)
-    min_distance = None
-    min_kml_file = None
-    for kml_file in kml_files:
-        for (polygon1, _) in make_polygons(kml_file):
-            d = polygon0.distance(polygon1)
-            if min_distance is None or d < min_distance:
-                min_distance = d
-                min_kml_file = kml_file
-    assert min_kml_file is not None
-    return min_kml_file
-
-# make_polygon_from_ext_ints():
-def make_polygon_from_ext_ints(exterior_kml_file, interior_kml_files):
-    polygons0 = make_polygons(exterior_kml_file)
-    assert len(polygons0) == 1
-    (polygon0, _) = polygons0[0]
-    interior_points = []
-    for interior_kml_file in interior_kml_files:
-        polygons1 = make_polygons(interior_kml_file)
-        assert len(polygons1) == 1
-        (polygon1, _) = polygons1[0]
-        interior_points.append(polygon1.exterior.coords)
-    return Polygon(polygon0.exterior.coords, interior_points)
+# get_geometry_reader():
+#   geometry stores are opened (mmapped) only once per process.
+_geometry_readers = {}
+def get_geometry_reader(geometry_name):
+    if geometry_name not in _geometry_readers:
+        _geometry_readers[geometry_name] = geomstore_open(geometry_name)
+    return _geometry_readers[geometry_name]
+
+# get_rings():
+#   (store, exterior_ring_id, [interior_ring_id,...])
+#   -> [exterior_coords, interior_coords,...]
+def get_rings(geometry_dir, ring_ids):
+    (store, ext_ring_id, int_ring_ids) = ring_ids
+    geometry_reader = get_geometry_reader(os.path.join(geometry_dir, store))
+    return [
+        geometry_reader.get(ring_id)
+        for ring_id in [ext_ring_id] + list(int_ring_ids)]
+
+# make_polygon(): [exterior_coords, interior_coords,...] -> polygon
+def make_polygon(rings):
+    return Polygon(rings[0], rings[1:])
+
+# get_polygon_bounds(): -> (minlat, minlng, maxlat, maxlng)
+def get_polygon_bounds(rings):
+    coords = rings[0]
+    (minlat, minlng) = coords.min(axis=0)
+    (maxlat, maxlng) = coords.max(axis=0)
+    return (float(minlat), float(minlng), float(maxlat), float(maxlng))
 
 # make_kml_file(): polygon -> kml_file
 def make_kml_file(polygon, title, dst_file):
@@ -209,247 +123,407 @@ def make_kml_file(polygon, title, dst_file):
     f.close()
     return
 
-# make_sfid2cvids():
-def make_sfid2cvids(etree_root):
+# parse_curve(): gml:Curve -> (curve_id, [(lat, lng),...])
+def parse_curve(curve):
+    curve_id = curve.get('{%s}id' % KSJ_NS['gml'])
+    segments = curve.find('gml:segments', KSJ_NS)
+    segment = segments.find('gml:LineStringSegment', KSJ_NS)
+    posList = segment.find('gml:posList', KSJ_NS)
+    points = []
+    for line in posList.text.splitlines():
+        s = line.strip()
+        if 0 < len(s):
+            (lat, lng) = [float(v) for v in s.split(' ')]
+            points.append((lat, lng))
+    return (curve_id, points)
+
+# parse_surface():
+#   gml:Surface -> (surface_id, (exterior_curve_id, [interior_curve_id,..]))
+def parse_surface(surface):
+    surface_id = surface.get('{%s}id' % KSJ_NS['gml'])
+    patches = surface.find('gml:patches', KSJ_NS)
+    patch = patches.find('gml:PolygonPatch', KSJ_NS)
+    # Polygon:exterior
+    exterior = patch.find('gml:exterior', KSJ_NS)
+    ext_ring = exterior.find('gml:Ring', KSJ_NS)
+    ext_curveMember = ext_ring.find('gml:curveMember', KSJ_NS)
+    ext_curveRef = ext_curveMember.get('{%s}href' % KSJ_NS['xlink'])
+    ext_curve_id = ext_curveRef.replace('#', '')
+    # Polygon:interior
+    interiors = patch.findall('gml:interior', KSJ_NS)
+    int_curve_ids = []
+    for interior in interiors:
+        int_ring = interior.find('gml:Ring', KSJ_NS)
+        int_curveMember = int_ring.find('gml:curveMember', KSJ_NS)
+        int_curveRef = int_curveMember.get(
+            '{%s}href' % KSJ_NS['xlink'])
+        int_curve_id = int_curveRef.replace('#', '')
+        int_curve_ids.append(int_curve_id)
+    return (surface_id, (ext_curve_id, int_curve_ids))
+
+# parse_boundary():
+#   ksj:AdministrativeBoundary -> (area_code, surface_id, area_names)
+def parse_boundary(boundary):
+    bounds = boundary.find('ksj:bounds', KSJ_NS)
+    boundsRef = bounds.get('{%s}href' % KSJ_NS['xlink'])
+    surface_id = boundsRef.replace('#', '')
+    elems = [
+        boundary.find('ksj:administrativeAreaCode', KSJ_NS),
+        boundary.find('ksj:prefectureName', KSJ_NS),
+        boundary.find('ksj:subPrefectureName', KSJ_NS),
+        boundary.find('ksj:countyName', KSJ_NS),
+        boundary.find('ksj:cityName', KSJ_NS)]
+    contents = [''] * len(elems)
+    for (i, elem) in enumerate(elems):
+        if elem is not None and elem.text is not None:
+            contents[i] = elem.text.strip()
+    return (contents[0], surface_id, contents[1:])
+
+# read_ksj_file():
+#   read gml:Curve, gml:Surface and ksj:AdministrativeBoundary objects
+#   from a KSJ file in a single pass with iterparse(),
+#   clearing each object once it is consumed
+#   (the XML tree is never built as a whole).
+#   - on_curve(curve_id, points) is called for each gml:Curve.
+#   -> (sfid2cvids, areacode2sfids, areacode2names)
+def read_ksj_file(ksj_file, on_curve):
+    CURVE_TAG = '{%s}Curve' % KSJ_NS['gml']
+    SURFACE_TAG = '{%s}Surface' % KSJ_NS['gml']
+    BOUNDARY_TAG = '{%s}AdministrativeBoundary' % KSJ_NS['ksj']
     # surface_id -> (exterior_curve_id, [interior_curve_id,..])
     sfid2cvids = {}
-    for surface in etree_root.findall('gml:Surface', KSJ_NS):
-        surface_id = surface.get('{%s}id' % KSJ_NS['gml'])
-        patches = surface.find('gml:patches', KSJ_NS)
-        patch = patches.find('gml:PolygonPatch', KSJ_NS)
-        # Polygon:exterior
-        exterior = patch.find('gml:exterior', KSJ_NS)
-        ext_ring = exterior.find('gml:Ring', KSJ_NS)
-        ext_curveMember = ext_ring.find('gml:curveMember', KSJ_NS)
-        ext_curveRef = ext_curveMember.get('{%s}href' % KSJ_NS['xlink'])
-        ext_curve_id = ext_curveRef.replace('#', '')
-        # Polygon:interior
-        interiors = patch.findall('gml:interior', KSJ_NS)
-        int_curve_ids = []
-        for interior in interiors:
-            int_ring = interior.find('gml:Ring', KSJ_NS)
-            int_curveMember = int_ring.find('gml:curveMember', KSJ_NS)
-            int_curveRef = int_curveMember.get(
-                '{%s}href' % KSJ_NS['xlink'])
-            int_curve_id = int_curveRef.replace('#', '')
-            int_curve_ids.append(int_curve_id)
-        sfid2cvids[surface_id] = (ext_curve_id, int_curve_ids)
-    return sfid2cvids
-
-# make_areacode2sfids():
-def make_areacode2sfids(ksj_root):
     areacode2sfids = {}
     areacode2names = {}
-    for boundary in ksj_root.findall('ksj:AdministrativeBoundary', KSJ_NS):
-        bounds = boundary.find('ksj:bounds', KSJ_NS)
-        boundsRef = bounds.get('{%s}href' % KSJ_NS['xlink'])
-        surface_id = boundsRef.replace('#', '')
-        elems = [
-            boundary.find('ksj:administrativeAreaCode', KSJ_NS),
-            boundary.find('ksj:prefectureName', KSJ_NS),
-            boundary.find('ksj:subPrefectureName', KSJ_NS),
-            boundary.find('ksj:countyName', KSJ_NS),
-            boundary.find('ksj:cityName', KSJ_NS)]
-        contents = [''] * len(elems)
-        for (i, elem) in enumerate(elems):
-            if elem is not None and elem.text is not None:
-                contents[i] = elem.text.strip()
-        area_code = contents[0]
-        if area_code == '':
-            # area code of '所属未定地' is None.
+    context = ET.iterparse(ksj_file, events=('start', 'end'))
+    (_, ksj_root) = next(context)
+    for (event, elem) in context:
+        if event != 'end':
             continue
-        # areacode2sfids
-        if area_code not in areacode2sfids:
-            areacode2sfids[area_code] = []
-        areacode2sfids[area_code].append(surface_id)
-        # areacode2names
-        if area_code not in areacode2names:
-            areacode2names[area_code] = contents[1:]
-    return (areacode2sfids, areacode2names)
-
-# make_curve_files():
-def make_curve_files(ksj_root, get_curve_fpath):
-    # make_polygon():
-    def make_polygon(pos_list_text):
-        points = []
-        for line in pos_list_text.splitlines():
-             s = line.strip()
-             if 0 < len(s):
-                (lat, lng) = [float(v) for v in s.split(' ')]
-                points.append((lat, lng))
-        return Polygon(points)
-    for curve in ksj_root.findall('gml:Curve', KSJ_NS):
-        curve_id = curve.get('{%s}id' % KSJ_NS['gml'])
-        segments = curve.find('gml:segments', KSJ_NS)
-        segment = segments.find('gml:LineStringSegment', KSJ_NS)
-        posList = segment.find('gml:posList', KSJ_NS)
-        polygon = make_polygon(posList.text)
-        fpath = get_curve_fpath(curve_id)
-        if not os.path.isdir(os.path.dirname(fpath)):
-            os.makedirs(os.path.dirname(fpath))
-        make_kml_file(polygon, curve_id, fpath)
-    return
+        if elem.tag == CURVE_TAG:
+            (curve_id, points) = parse_curve(elem)
+            on_curve(curve_id, points)
+        elif elem.tag == SURFACE_TAG:
+            (surface_id, curve_ids) = parse_surface(elem)
+            sfid2cvids[surface_id] = curve_ids
+        elif elem.tag == BOUNDARY_TAG:
+            (area_code, surface_id, area_names) = parse_boundary(elem)
+            if area_code == '':
+                # area code of '所属未定地' is None.
+                pass
+            else:
+                # areacode2sfids
+                if area_code not in areacode2sfids:
+                    areacode2sfids[area_code] = []
+                areacode2sfids[area_code].append(surface_id)
+                # areacode2names
+                if area_code not in areacode2names:
+                    areacode2names[area_code] = area_names
+        else:
+            continue
+        # the object has been consumed.
+        ksj_root.clear()
+    return (sfid2cvids, areacode2sfids, areacode2names)
 
-# make_areacode2curvefiles():
-def make_areacode2curvefiles(ksj_root, get_curve_fpath):
-    sfid2cvids = make_sfid2cvids(ksj_root)
-    (areacode2sfids, areacode2names) = make_areacode2sfids(ksj_root)
-    # areacode2curvefiles
-    # - key: area_code
-    # - val: (interior_curve_id, [exterior_curve_id, ...]), ...
-    areacode2curvefiles = {}
+# make_areacode2polygons():
+#   -> {area_code: [(store, exterior_ring_id, [interior_ring_id,...]),...]}
+def make_areacode2polygons(
+    sfid2cvids, areacode2sfids, curveid2ringid, store):
+    areacode2polygons = {}
     for (area_code, surface_ids) in areacode2sfids.items():
-        areacode2curvefiles[area_code] = []
+        areacode2polygons[area_code] = []
         for surface_id in surface_ids:
             # surface_id -> curve_id (exterior_id, [interior_id,...])
             (ext_cvid, int_cvids) = sfid2cvids[surface_id]
-            # curve_id -> curve file set (exterior, interiors)
-            curve_file_set = (
-                get_curve_fpath(ext_cvid),
-                [get_curve_fpath(int_cvid) for int_cvid in int_cvids]
-            )
-            areacode2curvefiles[area_code].append(curve_file_set)
-    return (areacode2curvefiles, areacode2names)
-
-# TODO: name
+            # curve_id -> ring_id (exterior, interiors)
+            areacode2polygons[area_code].append((
+                store,
+                curveid2ringid[ext_cvid],
+                [curveid2ringid[int_cvid] for int_cvid in int_cvids]
+            ))
+    return areacode2polygons
+
 # do_make_kml_files()
 def do_make_kml_files(args):
-    (area_code, curve_files, kml_dir, kml_index_dir) = args
+    (area_code, polygons, geometry_dir, kml_dir) = args
     pref_dir = os.path.join(kml_dir, get_pref_code(area_code))
-    try:
-        os.makedirs(pref_dir)
-    except OSError:
-        if os.path.isdir(pref_dir):
-            pass
-        else:
-            raise
-    for (i, (exterior_curve_file, interior_curve_files)) in (
-        enumerate(curve_files)):
-        # curve_file -> polygon
-        polygon = make_polygon_from_ext_ints(
-            exterior_curve_file, interior_curve_files)
-        # polygon -> .kml
-        kml_fname = '%s-%02d.kml' % (area_code, i + 1)
-        kml_fpath = os.path.join(pref_dir, kml_fname)
+    os.makedirs(pref_dir, exist_ok=True)
+    for (i, ring_ids) in enumerate(polygons):
+        polygon = make_polygon(get_rings(geometry_dir, ring_ids))
+        polygon_name = get_polygon_name(area_code, i)
+        kml_fpath = os.path.join(pref_dir, polygon_name + '.kml')
         make_kml_file(polygon, area_code, kml_fpath)
-        # update kml-index.
-        LENGTH = 4  # TODO: parameter
-        geohashes = encode_to_geohashes(polygon.bounds, length=LENGTH)
-        for geohash in geohashes:
-            dpath = os.path.join(
-                kml_index_dir, os.path.sep.join(geohash))
-            try:
-                os.makedirs(dpath)
-            except OSError as e:
-                if os.path.isdir(dpath):
-                    pass
-                else:
-                    raise
-            fpath = os.path.join(dpath, kml_fname)
-            assert not os.path.isfile(fpath)
-            open(fpath, 'w').close()
-    # TODO: %d/%d
-    #   write out area_code files only for counting?
-    print('Finished: writing kml files for area_code=%s)' % area_code)
     return
 
-# make_kml_files():
+# get_file_digest():
+def get_file_digest(fpath):
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as fp:
+        while True:
+            data = fp.read(1024 * 1024)
+            if len(data) == 0:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+# make_geometry_store():
 # output:
-# * kml/: contains KML files which define
-#         polygons of administrative boundaries.
-# * kml-index/: TODO
-def make_kml_files(ksj_file, kml_dir, kml_index_dir):
-    # tmpdir: 'tmp/' - contains KML files which define
-    #          polygons of administrative boundary fragments
-    #          (Curve objects in KSJ).
-    # (*) We write out boundary fragments,
-    #     that are read from a KSJ file, to (KML) files
-    #     in order to parse large KSJ file
+# * $(geometry_name).coords, $(geometry_name).index:
+#     a store of rings of administrative boundaries
+#     (Curve objects in KSJ). see geomstore.py.
+# * $(geometry_name).json:
+#     areacode2polygons and areacode2names of the KSJ file.
+# -> ({area_code: [(store, exterior_ring_id, [interior_ring_id,...]),...]},
+#     {area_code: area_names})
+def make_geometry_store(ksj_file, geometry_name):
+    # (*) Rings are written out to the store while reading
+    #     a KSJ file, in order to parse large KSJ file
     #     even on machines that don't have enough memory.
     #     e.g. N03-18_180101.xml: 500MB
     #          contains administrative areas of whole of Japan.
-    tmp_dir = os.path.join(kml_dir, 'tmp')
-    if os.path.isdir(tmp_dir):
-        shutil.rmtree(tmp_dir)
-    # get_curve_fpath():
-    CURVE_ID_PAT = re.compile(r'cv([0-9]+)_[0-9]+')
-    def get_curve_fpath(curve_id):
-        m = CURVE_ID_PAT.match(curve_id)
-        assert m is not None
-        i = int(m.group(1))
-        # up to 1000 files per directory (for debuggability).
-        dpath = os.path.join(tmp_dir, str(i // 1000))
-        return os.path.join(dpath, curve_id + '.kml')
-    # ksj_file -> {area_code: [curve_file(.kml)...]}
-    #   write out ksj:Curve objects (boundary fragments) to KML files.
-    ksj_root = ET.parse(ksj_file).getroot()
-    # ksj_root -> curve files (.kml)
-    make_curve_files(ksj_root, get_curve_fpath)
-    # ksj_root -> {area_code: [(int_curve_file, ext_curve_files), ...]}
-    (areacode2curvefiles, areacode2names) = \
-        make_areacode2curvefiles(ksj_root, get_curve_fpath)
-    # 
+    geometry_writer = geomstore_make(geometry_name)
+    # curve ids are unique only in a KSJ file.
+    curveid2ringid = {}
+    # add_curve(): (curve_id, points) -> geometry store
+    def add_curve(curve_id, points):
+        curveid2ringid[curve_id] = geometry_writer.add(points)
+        return
+    (sfid2cvids, areacode2sfids, areacode2names) = \
+        read_ksj_file(ksj_file, add_curve)
+    geometry_writer.finish()
+    areacode2polygons = make_areacode2polygons(
+        sfid2cvids, areacode2sfids, curveid2ringid,
+        os.path.basename(geometry_name))
+    with open(geometry_name + '.json', 'w') as fp:
+        json.dump((areacode2polygons, areacode2names), fp, indent=None)
+    return (areacode2polygons, areacode2names)
+
+# make_geometry_stores():
+#   make a geometry store for each KSJ file (named after its digest).
+#   the stores of the KSJ files that are not changed are reused.
+# -> ({area_code: [(store, exterior_ring_id, [interior_ring_id,...]),...]},
+#     {area_code: area_names},
+#     {ksj_file: digest})
+def make_geometry_stores(ksj_files, geometry_dir):
+    areacode2polygons = {}
+    areacode2names = {}
+    digests = {}
+    for ksj_file in ksj_files:
+        digest = get_file_digest(ksj_file)
+        digests[ksj_file] = digest
+        geometry_name = os.path.join(geometry_dir, digest)
+        if os.path.isfile(geometry_name + '.json'):
+            print('reusing: %s (%s)' % (ksj_file, digest))
+            with open(geometry_name + '.json', 'r') as fp:
+                (ac2polygons, ac2an) = json.load(fp)
+        else:
+            print('reading: %s...' % ksj_file)
+            (ac2polygons, ac2an) = \
+                make_geometry_store(ksj_file, geometry_name)
+        for (area_code, polygons) in ac2polygons.items():
+            areacode2polygons.setdefault(area_code, []).extend(polygons)
+        for (area_code, area_names) in ac2an.items():
+            areacode2names.setdefault(area_code, area_names)
+    # remove the stores of the KSJ files no longer used.
+    for fpath in glob(os.path.join(geometry_dir, '*.index')):
+        geometry_name = fpath[:-len('.index')]
+        if os.path.basename(geometry_name) not in digests.values():
+            for ext in ('.coords', '.index', '.json'):
+                if os.path.isfile(geometry_name + ext):
+                    os.remove(geometry_name + ext)
+    return (areacode2polygons, areacode2names, digests)
+
+# get_polygon_digests():
+#   -> {polygon_name: digest of its rings}
+def get_polygon_digests(areacode2polygons, geometry_dir):
+    polygon_digests = {}
+    for (area_code, polygons) in areacode2polygons.items():
+        for (i, ring_ids) in enumerate(polygons):
+            h = hashlib.sha1()
+            for coords in get_rings(geometry_dir, ring_ids):
+                h.update(coords.tobytes())
+                h.update(b'/')
+            polygon_digests[get_polygon_name(area_code, i)] = h.hexdigest()
+    return polygon_digests
+
+# get_root_digest():
+#   the output of a root is determined by
+#   its candidate polygons, n_geohash and hybrid.
+def get_root_digest(root, polygon_names, polygon_digests, n_geohash,
+    hybrid=False):
+    h = hashlib.sha1(('%s/%d' % (root, n_geohash)).encode())
+    if hybrid:
+        h.update(b'/hybrid')
+    for polygon_name in sorted(polygon_names):
+        h.update(('/%s:%s' % (
+            polygon_name, polygon_digests[polygon_name])).encode())
+    return h.hexdigest()
+
+# make_kml_files():
+# output:
+# * kml/: contains KML files which define
+#         polygons of administrative boundaries (for debugging).
+def make_kml_files(areacode2polygons, geometry_dir, kml_dir):
     mp_args = [
-        (area_code, curve_files, kml_dir, kml_index_dir)
-        for (area_code, curve_files) in areacode2curvefiles.items()
+        (area_code, polygons, geometry_dir, kml_dir)
+        for (area_code, polygons) in areacode2polygons.items()
     ]
     pool = mp.Pool()
     pool.map(do_make_kml_files, mp_args)
-    shutil.rmtree(tmp_dir)
-    return areacode2names
+    return
+
+# make_polygon_index():
+#   -> ([polygon_name,...], PolygonIndex)
+def make_polygon_index(areacode2polygons, geometry_dir):
+    polygon_names = []
+    bounds = []
+    for (area_code, polygons) in areacode2polygons.items():
+        for (i, ring_ids) in enumerate(polygons):
+            polygon_names.append(get_polygon_name(area_code, i))
+            bounds.append(
+                get_polygon_bounds(get_rings(geometry_dir, ring_ids)))
+    return (polygon_names, PolygonIndex(bounds))
+
+# make_roots():
+#   -> [(root_geohash, [polygon_name,...]),...]
+#   root geohashes (of length) cover all the polygons,
+#   and the candidate polygons of each root are looked up
+#   from the polygon index.
+def make_roots(polygon_names, polygon_index, length):
+    roots = set()
+    for bounds in polygon_index.bounds:
+        roots.update(cover(bounds, length))
+    retval = []
+    for root in sorted(roots):
+        (minlat0, minlng0, maxlat0, maxlng0) = decode_to_bounds(root)
+        names = []
+        for i in polygon_index.query(decode_to_bounds(root)):
+            (minlat1, minlng1, maxlat1, maxlng1) = polygon_index.bounds[i]
+            # bounds which only touch the root are not candidates.
+            # (same as cover())
+            if (minlat1 < maxlat0 and minlat0 < maxlat1 and
+                minlng1 < maxlng0 and minlng0 < maxlng1):
+                names.append(polygon_names[i])
+        retval.append((root, names))
+    return retval
 
 # make_areacode_directories()
-def make_areacode_directories(json_files, areacode_dir):
-    # write_entry()
-    def write_entry(geohash, area_code):
-        fpath = os.path.join(
-            areacode_dir, os.path.sep.join(geohash))
-        # - No duplication of geohash (one geohash -> one area code).
+#   sharded file structure:
+#   - areacode_dir/_shard: the length of the prefixes of shards.
+#   - areacode_dir/$(prefix): sorted lines of "geohash\tarea_code"
+#     of the geohashes that start with prefix.
+#   record_files must be sorted by their roots,
+#   and the roots must not be shorter than shard_depth
+#   so that the geohashes of a shard come in a row.
+def make_areacode_directories(record_files, areacode_dir, shard_depth):
+    # write_shard()
+    def write_shard(prefix, geohash2areacode):
+        fpath = os.path.join(areacode_dir, prefix)
+        # - A shard is written only once.
         assert not os.path.isfile(fpath)
-        # - The sub-geohashes of the geohash whose area code is
-        #   already defined don't have their area code definitions.
-        dirpath = os.path.dirname(fpath)
-        assert not os.path.isdir(fpath)
-        assert not os.path.isfile(dirpath)
-        if not os.path.isdir(os.path.dirname(fpath)):
-            os.makedirs(os.path.dirname(fpath))
         with open(fpath, 'w') as fp:
-            fp.write(area_code)
+            for geohash in sorted(geohash2areacode.keys()):
+                fp.write('%s\t%s\n' % (geohash, geohash2areacode[geohash]))
         return
     #
-    for json_file in json_files:
-        with open(json_file, 'r') as fp:
-            geohash2areacode = json.load(fp)
-            for (geohash, area_code) in geohash2areacode.items():
-                write_entry(geohash, area_code)
+    if os.path.isdir(areacode_dir):
+        shutil.rmtree(areacode_dir)
+    os.makedirs(areacode_dir)
+    with open(os.path.join(areacode_dir, '_shard'), 'w') as fp:
+        fp.write('%d\n' % shard_depth)
+    prefix = None
+    geohash2areacode = {}
+    for (geohash, area_code) in read_records_many(record_files):
+        assert shard_depth <= len(geohash)
+        if geohash[:shard_depth] != prefix:
+            if prefix is not None:
+                write_shard(prefix, geohash2areacode)
+            prefix = geohash[:shard_depth]
+            geohash2areacode = {}
+        # - No duplication of geohash (one geohash -> one area code).
+        assert geohash not in geohash2areacode
+        geohash2areacode[geohash] = area_code
+    if prefix is not None:
+        write_shard(prefix, geohash2areacode)
     return
 
-# merge_json_files():
-def merge_json_files(json_files, json_file):
+# make_json():
+#   merge record files into a json file
+#   (one record file at a time).
+def make_json(record_files, json_file):
     with open(json_file, 'w') as fdst:
         fdst.write('{')
-        for (i, src) in enumerate(json_files):
-            with open(src, 'r') as fsrc:
-                # we treat this file as plain text file,
-                # instead of parsing as json file (for efficiency).
-                s = fsrc.read()
-                assert s[0] == '{' and s[-1] == '}'
-                fdst.write(s[1:-1])
-                if i != len(json_files) - 1:
-                    fdst.write(',')
+        sep = ''
+        for src in record_files:
+            entries = [
+                '%s: %s' % (json.dumps(k), json.dumps(v))
+                for (k, v) in read_records(src)]
+            if 0 < len(entries):
+                fdst.write(sep)
+                fdst.write(', '.join(entries))
+                sep = ', '
         fdst.write('}')
     return
 
+# get_cdb_size(record_files) -> the size of the cdb file in bytes
+#   a record (4+klen+vlen bytes) in record files takes
+#   8+klen+vlen bytes of a record and 16 bytes of cells (2 cells) in cdb.
+def get_cdb_size(record_files):
+    size = sum(os.path.getsize(src) for src in record_files)
+    n_records = sum(count_records(src) for src in record_files)
+    return 2048 + size + (4 + 16) * n_records
+
 # make_cdb():
-def make_cdb(json_files, cdb_file):
-    cdb_writer = cdbmake(cdb_file)
-    for (i, src) in enumerate(json_files):
-        with open(src, 'r') as fsrc:
-            for (k, v) in json.load(fsrc).items():
-                cdb_writer.add(k, v)
+#   cdb64 is made if cdb64 is True.
+def make_cdb(record_files, cdb_file, cdb64=False):
+    if cdb64:
+        cdb_writer = cdb64make(cdb_file)
+    else:
+        cdb_writer = cdbmake(cdb_file)
+    cdb_writer.add_many(read_records_many(record_files))
     cdb_writer.finish()
     return
 
+# make_bin():
+#   geohash2areacode and areacode2name in one bin file.
+def make_bin(record_files, areacode2names, bin_file):
+    ac2an = {}
+    for (ac, names) in areacode2names.items():
+        ac2an[ac] = area_names_to_string(names)
+    bin_writer = bindb_make(bin_file, ac2an)
+    for (k, v) in read_records_many(record_files):
+        bin_writer.add(k, v)
+    bin_writer.finish()
+    return
+
+# make_spec(n_geohash, spec_file)
+#   the spec of the DB, which is read by query_db.load_n_chars().
+def make_spec(n_geohash, spec_file):
+    with open(spec_file, 'w') as fp:
+        json.dump({'n_chars': n_geohash}, fp, indent=None)
+    return
+
+# make_levels():
+#   level index: {"depth": depth, "levels": {prefix: bitmask}}
+#   bit n of the bitmask of a prefix (of depth chars) is set
+#   if some geohash of length n is a prefix of it or under it,
+#   so that a lookup probes only those lengths.
+def make_levels(record_files, depth, levels_file):
+    levels = {}
+    for (geohash, _) in read_records_many(record_files):
+        bit = 1 << len(geohash)
+        if depth <= len(geohash):
+            prefix = geohash[:depth]
+            levels[prefix] = levels.get(prefix, 0) | bit
+            continue
+        prefixes = [geohash]
+        for _ in range(depth - len(geohash)):
+            prefixes = [p + c for p in prefixes for c in BASE32]
+        for prefix in prefixes:
+            levels[prefix] = levels.get(prefix, 0) | bit
+    with open(levels_file, 'w') as fp:
+        json.dump({'depth': depth, 'levels': levels}, fp, indent=None)
+    return
+
 # area_names_to_string():
 def area_names_to_string(area_names):
     return ' '.join([v for v in area_names if v != ''])
@@ -464,156 +538,542 @@ def make_areacode2name_json(areacode2names, json_file):
     return
 
 # make_areacode2name_directories():
+#   dir_path/$(area_code): area name
 def make_areacode2name_directories(areacode2names, dir_path):
-    # TODO
+    if os.path.isdir(dir_path):
+        shutil.rmtree(dir_path)
+    os.makedirs(dir_path)
+    for (area_code, area_names) in areacode2names.items():
+        with open(os.path.join(dir_path, area_code), 'w') as fp:
+            fp.write(area_names_to_string(area_names))
     return
 
 # make_areacode2name_cdb():
 def make_areacode2name_cdb(areacode2names, cdb_file):
     cdb_writer = cdbmake(cdb_file)
-    for (area_code, area_names) in areacode2names.items():
-        cdb_writer.add(
-            area_code, area_names_to_string(area_names))
+    cdb_writer.add_many(
+        (area_code, area_names_to_string(area_names))
+        for (area_code, area_names) in areacode2names.items())
     cdb_writer.finish()
     return
 
-# make_json():
-def make_json(args): 
-    (geohash_char, kml_dir, kml_index_dir, n_index_dirs, n_geohash, json_dir) = args
-    # make_polygon1()
-    def make_polygon1(lat_lng_range):
-        ((minlat, maxlat), (minlng, maxlng)) = lat_lng_range
-        return Polygon([
-            (minlat, minlng),
-            (minlat, maxlng),
-            (maxlat, maxlng),
-            (maxlat, minlng),
-            (minlat, minlng)
-        ])
-
-    ##
-    def doit(geohash, polygon, area_code,
-        geohash2areacode, geohash2candidates):
-        for (geohash1, range1) in get_sub_geohashes(geohash):
-            polygon1 = make_polygon1(range1)
-            if polygon.intersects(polygon1):
-                if polygon.contains(polygon1):
-                    geohash2areacode[geohash1] = area_code
-                elif len(geohash1) < n_geohash:
-                    doit(geohash1, polygon, area_code,
-                        geohash2areacode, geohash2candidates)
-                else:
-                    if geohash1 in geohash2candidates:
-                        geohash2candidates[geohash1].append(
-                            (polygon, area_code))
-                    else:
-                        geohash2candidates[geohash1] = [
-                            (polygon, area_code)]
-            else:
-                # polygon1 is outside of polygon.
-                pass
-        return
-    #
-    for (root, dirs, files) in os.walk(kml_index_dir):
-        if len(files) < 1 or not root.endswith(geohash_char):
+# make_boundary(boundary_files, n_chars, boundary_file)
+#   merge the boundary files of the roots.
+def make_boundary(boundary_files, n_chars, boundary_file):
+    writer = boundary_make(boundary_file, n_chars)
+    for path in boundary_files:
+        reader = boundary_open(path)
+        for (key, data) in reader.items_packed():
+            writer.add_packed(key, data)
+        reader.close()
+    writer.finish()
+    print('- %d boundary cells' % writer.numentries)
+    return
+
+# compact_geohash2areacode():
+#   replace 32 sub-geohashes of the same area code with their parent
+#   (bottom-up, so that merged parents can be merged again).
+#   parents are not shorter than min_length.
+#   -> the number of removed geohashes
+def compact_geohash2areacode(geohash2areacode, min_length=1):
+    n0 = len(geohash2areacode)
+    length2geohashes = {}
+    for geohash in geohash2areacode.keys():
+        length2geohashes.setdefault(len(geohash), []).append(geohash)
+    for length in range(
+        max(length2geohashes.keys(), default=0), min_length, -1):
+        parent2children = {}
+        for geohash in length2geohashes.get(length, []):
+            parent2children.setdefault(geohash[:-1], []).append(geohash)
+        for (parent, children) in parent2children.items():
+            if len(children) < len(BASE32):
+                continue
+            area_codes = set(geohash2areacode[child] for child in children)
+            if len(area_codes) != 1:
+                continue
+            if next(iter(area_codes)).startswith(BOUNDARY_PREFIX):
+                # boundary cells (hybrid) have their own polygons.
+                continue
+            # - The sub-geohashes of the geohash whose area code is
+            #   already defined don't have their area code definitions,
+            #   so the complete children have no sub-geohashes.
+            for child in children:
+                del geohash2areacode[child]
+            geohash2areacode[parent] = area_codes.pop()
+            length2geohashes.setdefault(length - 1, []).append(parent)
+    return n0 - len(geohash2areacode)
+
+# get_record_file(): e.g. 'xn76' -> record_dir/x/n/7/6.rec
+def get_record_file(record_dir, root):
+    return os.path.join(record_dir, os.path.sep.join(root) + '.rec')
+
+# get_boundary_file(): e.g. 'xn76' -> record_dir/x/n/7/6.bnd
+def get_boundary_file(record_dir, root):
+    return os.path.join(record_dir, os.path.sep.join(root) + '.bnd')
+
+# get_record_root(): e.g. record_dir/x/n/7/6.rec -> 'xn76'
+def get_record_root(record_dir, record_file):
+    path = os.path.relpath(record_file, record_dir)
+    return os.path.splitext(path)[0].replace(os.path.sep, '')
+
+# compact_roots(record_dir, merged_dir, min_length) -> record_files
+#   compact_geohash2areacode() of each root stops at the root, so
+#   the roots which are wholly of one area code (a record of the root)
+#   are compacted again across the roots here.
+#   the merged parents are written to merged_dir
+#   (the record files of the roots are kept for incremental builds),
+#   and the record files of the DB are returned (sorted by their roots).
+def compact_roots(record_dir, merged_dir, min_length=1):
+    root2file = dict(
+        (get_record_root(record_dir, path), path)
+        for path in glob(record_dir + '/**/*.rec', recursive=True))
+    root2areacode = {}
+    for (root, path) in root2file.items():
+        # a record of the root: klen(H), vlen(H), root, area code
+        # (only small files are read).
+        if 4 + len(root) + 256 < os.path.getsize(path):
             continue
-        t0 = time()
-        #
-        polygons = []
-        for fname in files:
-            (area_code, _) = fname.split('-')
-            kml_file = os.path.join(
-                kml_dir, get_pref_code(area_code), fname)
-            polygon = make_polygon(kml_file)
-            polygons.append((polygon, area_code))
-        #
-        geohash = get_geohash(root)
-        geohash2areacode = {}
-        geohash2candidates = {}
-        for (polygon, area_code) in polygons:
-            doit(geohash, polygon, area_code,
-                geohash2areacode, geohash2candidates)
-        #
-        for (geohash, candidates) in geohash2candidates.items():
-            assert(0 < len(candidates))
-            if len(candidates) == 1:
-                (_, area_code) = candidates[0]
+        records = list(read_records(path))
+        if len(records) == 1 and records[0][0] == root:
+            root2areacode[root] = records[0][1]
+    compacted = dict(root2areacode)
+    compact_geohash2areacode(compacted, min_length)
+    if os.path.isdir(merged_dir):
+        shutil.rmtree(merged_dir)
+    for root in set(root2areacode.keys()) - set(compacted.keys()):
+        del root2file[root]
+    parents = set(compacted.keys()) - set(root2areacode.keys())
+    for parent in parents:
+        path = get_record_file(merged_dir, parent)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        recmake(path).add(parent, compacted[parent]).finish()
+        root2file[parent] = path
+    print('- compacted across roots: %d roots -> %d geohashes' % (
+        len(root2areacode) - len(compacted) + len(parents), len(parents)))
+    return [root2file[root] for root in sorted(root2file.keys())]
+
+# hybrid mode:
+#   the area code of a boundary cell of several areas is
+#   BOUNDARY_PREFIX + the default area code,
+#   and the cell has the polygons of the areas clipped by the cell
+#   in the boundary file (for the point-in-polygon test at query time).
+
+# get_boundary_parts():
+#   clipped: [(area_code, clipped),...] by resolve_candidates()
+#   -> [(area_code, [ring,...]),...]
+#      the simplified polygons of the areas clipped by the cell.
+def get_boundary_parts(geohash, clipped):
+    (minlat, minlng, maxlat, maxlng) = decode_to_bounds(geohash)
+    tolerance = min(maxlat - minlat, maxlng - minlng) / 100
+    areacode2rings = {}
+    for (area_code, clipped) in clipped:
+        clipped = clipped.simplify(tolerance, preserve_topology=True)
+        for geom in getattr(clipped, 'geoms', [clipped]):
+            if geom.geom_type != 'Polygon' or geom.is_empty:
+                # touches the cell.
+                continue
+            rings = areacode2rings.setdefault(area_code, [])
+            rings.append(list(geom.exterior.coords))
+            rings.extend(list(interior.coords) for interior in geom.interiors)
+    return sorted(areacode2rings.items())
+
+# init_make_records():
+#   initialize a worker process of make_records().
+_make_records_config = None
+def init_make_records(geometry_dir, polygons_json, n_geohash, record_dir,
+    hybrid=False):
+    global _make_records_config
+    with open(polygons_json, 'r') as fp:
+        areacode2polygons = json.load(fp)
+    _make_records_config = (
+        geometry_dir, areacode2polygons, n_geohash, record_dir, hybrid)
+    return
+
+# make_records():
+#   root geohash and its candidate polygons -> record file
+#   -> (root, record_file, n_removed, n_ambiguous, elapsed_time)
+def make_records(args):
+    (root, polygon_names) = args
+    (geometry_dir, areacode2polygons, n_geohash, record_dir, hybrid) = \
+        _make_records_config
+    t0 = time()
+    #
+    polygons = []
+    for polygon_name in polygon_names:
+        (area_code, i) = parse_polygon_name(polygon_name)
+        polygon = make_polygon(
+            get_rings(geometry_dir, areacode2polygons[area_code][i]))
+        polygons.append((polygon, area_code))
+    #
+    geohash2areacode = {}
+    geohash2candidates = {}
+    for (polygon, area_code) in polygons:
+        subdivider = Subdivider(polygon, n_geohash)
+        for (geohash, state) in subdivider.subdivide(root):
+            if state == INSIDE:
                 geohash2areacode[geohash] = area_code
+            elif geohash in geohash2candidates:
+                geohash2candidates[geohash].append((polygon, area_code))
             else:
-                polygon0 = make_polygon1(decode_to_range(geohash))
-                best = None
-                for (polygon, area_code) in candidates:
-                    d = polygon0.distance(polygon)
-                    if best is None or d < best[0]:
-                        best = (d, area_code)
-                (_, area_code)
-                geohash2areacode[geohash] = area_code
-        json_file = os.path.join(json_dir,
-            os.path.sep.join(geohash) + '.json')
-        if not os.path.isdir(os.path.dirname(json_file)):
-            os.makedirs(os.path.dirname(json_file))
-        if 0 < len(geohash2areacode):
-            with open(json_file, 'w') as fp:
-                json.dump(geohash2areacode, fp, indent=None)
-        i_files = len(glob(json_dir + '/**/*.json', recursive=True))
+                geohash2candidates[geohash] = [(polygon, area_code)]
+    # - The cells inside a polygon are not resolved again.
+    for geohash in geohash2areacode.keys():
+        geohash2candidates.pop(geohash, None)
+    (geohash2resolved, n_ambiguous) = resolve_candidates(geohash2candidates)
+    geohash2parts = {}
+    for (geohash, (area_code, clipped)) in geohash2resolved.items():
+        geohash2areacode[geohash] = area_code
+        if hybrid and 0 < len(clipped):
+            parts = get_boundary_parts(geohash, clipped)
+            if 1 < len(parts):
+                geohash2parts[geohash] = parts
+                geohash2areacode[geohash] = BOUNDARY_PREFIX + area_code
+    n_removed = compact_geohash2areacode(geohash2areacode)
+    boundary_file = get_boundary_file(record_dir, root)
+    if 0 < len(geohash2parts):
+        os.makedirs(os.path.dirname(boundary_file), exist_ok=True)
+        boundary_writer = boundary_make(boundary_file, n_geohash)
+        for (geohash, parts) in geohash2parts.items():
+            boundary_writer.add(geohash, parts)
+        boundary_writer.finish()
+    elif os.path.isfile(boundary_file):
+        # written by the previous build.
+        os.remove(boundary_file)
+    record_file = get_record_file(record_dir, root)
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    if 0 < len(geohash2areacode):
+        recmake(record_file).add_many(geohash2areacode.items()).finish()
+    elif os.path.isfile(record_file):
+        # written by the previous build.
+        os.remove(record_file)
+    return (root, record_file, n_removed, n_ambiguous, time() - t0)
+
+# schedule_roots():
+#   -> [(root, [polygon_name,...]),...] sorted by the estimated cost
+#      (the heaviest first).
+#   the cost of a root is estimated by the number of vertices
+#   of its candidate polygons.
+def schedule_roots(roots, areacode2polygons, geometry_dir):
+    # get_n_points()
+    def get_n_points(polygon_name):
+        (area_code, i) = parse_polygon_name(polygon_name)
+        rings = get_rings(geometry_dir, areacode2polygons[area_code][i])
+        return sum(len(coords) for coords in rings)
+    name2cost = {}
+    costs = []
+    for (root, polygon_names) in roots:
+        cost = 0
+        for polygon_name in polygon_names:
+            if polygon_name not in name2cost:
+                name2cost[polygon_name] = get_n_points(polygon_name)
+            cost += name2cost[polygon_name]
+        costs.append(cost)
+    order = sorted(range(len(roots)), key=lambda i: -costs[i])
+    return [roots[i] for i in order]
+
+# make_record_files():
+#   make record files of roots in parallel.
+def make_record_files(roots, geometry_dir, polygons_json,
+    n_geohash, record_dir, hybrid=False, n_procs=None):
+    if n_procs is None:
+        n_procs = mp.cpu_count()
+    # small chunks keep all the processes busy until the end.
+    chunksize = max(1, min(16, len(roots) // (n_procs * 8)))
+    pool = mp.Pool(n_procs, init_make_records,
+        (geometry_dir, polygons_json, n_geohash, record_dir, hybrid))
+    n_removed = 0
+    n_ambiguous = 0
+    for (i, (root, record_file, n_removed1, n_ambiguous1, t)) in enumerate(
+        pool.imap_unordered(make_records, roots, chunksize)):
         print('Finished: [%d/%d] %s -> %s (%.2f sec)' % (
-            i_files, n_index_dirs, root, json_file, time() - t0))
+            i + 1, len(roots), root, record_file, t))
+        n_removed += n_removed1
+        n_ambiguous += n_ambiguous1
+    pool.close()
+    pool.join()
+    print('- ambiguous: %d cells of several areas' % n_ambiguous)
+    print('- compacted: %d geohashes removed' % n_removed)
     return
 
 ####
 
+# the version of build_dir/manifest.json.
+#   increment this when the outputs of make_records() are changed
+#   so that incremental builds don't reuse old outputs.
+MANIFEST_VERSION = 4
+
+# get_peak_rss() -> (self, children) in bytes
+#   the peak RSS of this process and of its terminated children
+#   (the workers of make_record_files()); (0, 0) if unavailable.
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return (0, 0)
+    # ru_maxrss: bytes (macOS) or kilobytes (others).
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return tuple(
+        resource.getrusage(who).ru_maxrss * unit
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+# RSSSampler
+#   samples the RSS of this process and the total RSS of its children
+#   (the workers of make_record_files()) from /proc in a thread,
+#   so that the peaks of each stage are known (ru_maxrss of
+#   get_peak_rss() is the peak of the lifetime, not of a stage).
+#   without /proc (other than Linux), the peaks so far are returned.
+class RSSSampler(object):
+
+    INTERVAL = 0.05
+
+    # RSSSampler()
+    def __init__(self):
+        self.available = os.path.isfile('/proc/self/statm')
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if self.available else 0
+        self._peaks = (0, 0)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.available:
+            self.sample()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return
+
+    # get_rss(pid) -> bytes (0 if the process is gone)
+    def get_rss(self, pid):
+        try:
+            with open('/proc/%s/statm' % pid, 'r') as fp:
+                return int(fp.read().split()[1]) * self._page_size
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    # get_children() -> [pid,...]
+    def get_children(self):
+        pids = []
+        for tid in os.listdir('/proc/self/task'):
+            try:
+                with open('/proc/self/task/%s/children' % tid, 'r') as fp:
+                    pids.extend(fp.read().split())
+            except OSError:
+                pass
+        return pids
+
+    # sample()
+    def sample(self):
+        rss = self.get_rss('self')
+        rss_children = sum(self.get_rss(pid) for pid in self.get_children())
+        with self._lock:
+            self._peaks = (
+                max(self._peaks[0], rss), max(self._peaks[1], rss_children))
+        return
+
+    # _run()
+    def _run(self):
+        while not self._stopped.wait(self.INTERVAL):
+            self.sample()
+        return
+
+    # reset() -> (self, children) in bytes
+    #   the peaks since the last reset (the previous stage).
+    def reset(self):
+        if not self.available:
+            return get_peak_rss()
+        self.sample()
+        with self._lock:
+            peaks = self._peaks
+            self._peaks = (0, 0)
+        # the next stage starts from the current RSS.
+        self.sample()
+        return peaks
+
+    # stop()
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        return
+
+# get_output_size(paths) -> bytes
+#   the total size of files (and of files under directories).
+def get_output_size(paths):
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for (dir_path, _, fnames) in os.walk(path):
+                size += sum(
+                    os.path.getsize(os.path.join(dir_path, fname))
+                    for fname in fnames)
+    return size
+
+# end_stage(stats, sampler, stage, t_start, paths) -> t_end
+#   appends the wall time, the peak RSS (by sampler) and the output size
+#   of a stage of make_db() to stats (if not None).
+#   rss_sampled: False if the peak RSS is of the lifetime so far.
+def end_stage(stats, sampler, stage, t_start, paths=()):
+    t_end = time()
+    if stats is not None:
+        (peak_rss, peak_rss_children) = sampler.reset()
+        stats.append({
+            'stage': stage,
+            'wall_time': t_end - t_start,
+            'peak_rss': peak_rss,
+            'peak_rss_children': peak_rss_children,
+            'rss_sampled': sampler.available,
+            'output_size': get_output_size(paths)
+        })
+    return t_end
+
 # make_db():
-def make_db(ksj_files, db_type, build_dir, n_geohash=7):
+#   stats: a list to which the stats of each stage are appended
+#   by end_stage() (for bench/).
+def make_db(ksj_files, db_type, build_dir, n_geohash=7, kml=False,
+    split_depth=4, incremental=False, level_depth=0, hybrid=False,
+    stats=None):
+    if db_type not in ('json', 'cdb', 'fs', 'bin'):
+        raise ValueError(db_type)
     print('start creating database.')
     print('- ksj_files: %s' % ','.join(ksj_files))
     print('- build_dir: %s' % build_dir)
     print('- db_type: %s' % db_type)
     print('- geohash_length: %d' % n_geohash)
+    print('- split_depth: %d' % split_depth)
+    print('- incremental: %s' % incremental)
+    print('- level_depth: %d' % level_depth)
+    print('- hybrid: %s' % hybrid)
     print('- cpu_count: %d' % mp.cpu_count())
-    t0 = time()
-    # build_dir/kml
-    kml_dir = os.path.join(build_dir, 'kml')
-    kml_index_dir = os.path.join(build_dir, 'kml-index')
-    areacode2names = {}
-    assert not os.path.isdir(kml_dir)
-    assert not os.path.isdir(kml_index_dir)
-    os.makedirs(kml_dir)
-    os.makedirs(kml_index_dir)
-    for ksj_file in ksj_files:
-        # parse
-        print('reading: %s...' % ksj_file)
-        ac2an = make_kml_files(ksj_file, kml_dir, kml_index_dir)
-        areacode2names.update(ac2an)
-    n_index_dirs = 0
-    for (_, _, files) in os.walk(kml_index_dir):
-        n_index_dirs += 1 if 0 < len(files) else 0
-    # build_dir/geohash
-    json_dir = os.path.join(build_dir, 'json')
-    assert not os.path.isdir(json_dir)
-    os.makedirs(json_dir)
-    mp_args = [
-        (char, kml_dir, kml_index_dir, n_index_dirs, n_geohash, json_dir)
-        for char in BASE32]
-    pool = mp.Pool()
-    pool.map(make_json, mp_args)
-    json_files = glob(json_dir + '/**/*.json', recursive=True)
+    # the RSS is sampled only for stats.
+    sampler = RSSSampler() if stats is not None else None
+    t0 = t1 = time()
+    # build_dir/manifest.json
+    #   digests of the inputs of the previous build.
+    manifest_json = os.path.join(build_dir, 'manifest.json')
+    manifest = {}
+    if incremental and os.path.isfile(manifest_json):
+        with open(manifest_json, 'r') as fp:
+            manifest = json.load(fp)
+        if manifest.get('version') != MANIFEST_VERSION:
+            manifest = {}
+    # build_dir/geometry
+    geometry_dir = os.path.join(build_dir, 'geometry')
+    polygons_json = os.path.join(geometry_dir, 'polygons.json')
+    os.makedirs(geometry_dir, exist_ok=True)
+    (areacode2polygons, areacode2names, input_digests) = \
+        make_geometry_stores(ksj_files, geometry_dir)
+    with open(polygons_json, 'w') as fp:
+        json.dump(areacode2polygons, fp, indent=None)
+    t1 = end_stage(stats, sampler, 'parse', t1, [geometry_dir])
+    # build_dir/kml (for debugging)
+    if kml:
+        kml_dir = os.path.join(build_dir, 'kml')
+        if os.path.isdir(kml_dir):
+            shutil.rmtree(kml_dir)
+        make_kml_files(areacode2polygons, geometry_dir, kml_dir)
+        t1 = end_stage(stats, sampler, 'kml', t1, [kml_dir])
+    # polygon index
+    (polygon_names, polygon_index) = \
+        make_polygon_index(areacode2polygons, geometry_dir)
+    split_depth = max(1, min(split_depth, n_geohash - 1))
+    roots = make_roots(polygon_names, polygon_index, split_depth)
+    # roots to be (re)computed.
+    polygon_digests = get_polygon_digests(areacode2polygons, geometry_dir)
+    root_digests = dict(
+        (root, get_root_digest(
+            root, polygon_names1, polygon_digests, n_geohash, hybrid))
+        for (root, polygon_names1) in roots)
+    record_dir = os.path.join(build_dir, 'records')
+    old_root_digests = manifest.get('roots', {})
+    for root in old_root_digests.keys():
+        if root in root_digests:
+            continue
+        for path in (get_record_file(record_dir, root),
+            get_boundary_file(record_dir, root)):
+            if os.path.isfile(path):
+                os.remove(path)
+    roots = [
+        (root, polygon_names1) for (root, polygon_names1) in roots
+        if root_digests[root] != old_root_digests.get(root)]
+    if incremental:
+        old_digests = manifest.get('polygons', {})
+        print('- changed inputs: %d/%d' % (
+            len(set(input_digests.values()) - set(
+                manifest.get('inputs', {}).values())),
+            len(ksj_files)))
+        print('- changed polygons: %d/%d' % (
+            len([name for (name, digest) in polygon_digests.items()
+                if old_digests.get(name) != digest]),
+            len(polygon_digests)))
+        print('- changed roots: %d/%d' % (len(roots), len(root_digests)))
+    roots = schedule_roots(roots, areacode2polygons, geometry_dir)
+    t1 = end_stage(stats, sampler, 'index', t1)
+    # build_dir/records
+    os.makedirs(record_dir, exist_ok=True)
+    make_record_files(
+        roots, geometry_dir, polygons_json, n_geohash, record_dir, hybrid)
+    # 3-char shards of fs (at most the length of roots),
+    # and no merged parents shorter than the shards.
+    shard_depth = min(3, split_depth)
+    merged_dir = os.path.join(build_dir, 'merged')
+    record_files = compact_roots(record_dir, merged_dir,
+        shard_depth if db_type == 'fs' else 1)
+    t1 = end_stage(stats, sampler, 'records', t1, [record_dir, merged_dir])
+    with open(manifest_json, 'w') as fp:
+        json.dump({
+            'version': MANIFEST_VERSION,
+            'inputs': input_digests,
+            'polygons': polygon_digests,
+            'roots': root_digests
+        }, fp, indent=None)
     if db_type == 'json':
-        print('Merging json files...')
+        print('Making a json file from record files...')
         gh2ac = os.path.join(build_dir, 'geohash2areacode.json')
-        merge_json_files(json_files, gh2ac)
+        make_json(record_files, gh2ac)
         ac2an = os.path.join(build_dir, 'areacode2name.json')
         make_areacode2name_json(areacode2names, ac2an)
     elif db_type == 'cdb':
-        print('Making a cdb file from json files...')
-        gh2ac = os.path.join(build_dir, 'geohash2areacode.cdb')
-        make_cdb(json_files, gh2ac)
+        # cdb64 only for DBs that don't fit in cdb (>= 4GB).
+        cdb64 = (CDB_MAX_SIZE <= get_cdb_size(record_files))
+        if cdb64:
+            print('Making a cdb64 file from record files...')
+            gh2ac = os.path.join(build_dir, 'geohash2areacode.cdb64')
+        else:
+            print('Making a cdb file from record files...')
+            gh2ac = os.path.join(build_dir, 'geohash2areacode.cdb')
+        make_cdb(record_files, gh2ac, cdb64)
         ac2an = os.path.join(build_dir, 'areacode2name.cdb')
         make_areacode2name_cdb(areacode2names, ac2an)
     elif db_type == 'fs':
         print('Making a database in the form of file structure...')
         gh2ac = os.path.join(build_dir, 'geohash2areacode')
-        make_areacode_directories(json_files, gh2ac)
+        make_areacode_directories(record_files, gh2ac, shard_depth)
         ac2an = os.path.join(build_dir, 'areacode2name')
         make_areacode2name_directories(areacode2names, ac2an)
+    elif db_type == 'bin':
+        print('Making a bin file from record files...')
+        gh2ac = os.path.join(build_dir, 'geohash2areacode.bin')
+        make_bin(record_files, areacode2names, gh2ac)
+        ac2an = gh2ac
+    make_spec(n_geohash, os.path.join(build_dir, 'geohash2areacode.spec.json'))
+    t1 = end_stage(stats, sampler, db_type, t1, set([gh2ac, ac2an]))
+    if 0 < level_depth:
+        print('Making a level index...')
+        level_depth = min(level_depth, n_geohash)
+        levels = os.path.join(build_dir, 'geohash2areacode.levels.json')
+        make_levels(record_files, level_depth, levels)
+        t1 = end_stage(stats, sampler, 'levels', t1, [levels])
+    boundary = os.path.join(build_dir, 'geohash2areacode.boundary')
+    if hybrid:
+        print('Making a boundary file...')
+        boundary_files = sorted(
+            glob(record_dir + '/**/*.bnd', recursive=True))
+        make_boundary(boundary_files, n_geohash, boundary)
+        t1 = end_stage(stats, sampler, 'boundary', t1, [boundary])
+    elif os.path.isfile(boundary):
+        os.remove(boundary)
+    if sampler is not None:
+        sampler.stop()
     print('Finished: %.2f sec' % (time() - t0))
     return
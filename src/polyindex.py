@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# polyindex.py - in-memory spatial index (STRtree) of polygons.
+# Polygons are indexed by their bounds (minlat, minlng, maxlat, maxlng),
+# and referred to by their indexes in the list given to PolygonIndex().
+
+import sys
+import shapely
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+# shapely 2.x (vectorized operations); also used by subdivide and resolve.
+SHAPELY_2 = (2 <= int(shapely.__version__.split('.')[0]))
+
+# PolygonIndex
+class PolygonIndex(object):
+
+    # PolygonIndex(bounds)
+    # - bounds: [(minlat, minlng, maxlat, maxlng),...]
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self._tree = STRtree([box(*b) for b in self.bounds])
+        return
+
+    # __len__()
+    def __len__(self):
+        return len(self.bounds)
+
+    # query(bounds) -> [index,...]
+    #   indexes of the polygons whose bounds intersect with bounds.
+    def query(self, bounds):
+        if len(self.bounds) == 0:
+            return []
+        if SHAPELY_2:
+            indexes = self._tree.query(box(*bounds))
+        else:
+            indexes = self._tree.query_items(box(*bounds))
+        return sorted(int(i) for i in indexes)
+
+# test()
+def test():
+    polygons = [
+        box(0.0, 0.0, 1.0, 1.0),
+        box(2.0, 0.0, 3.0, 1.0),
+        shapely.geometry.Polygon([(1.4, 1.5), (2.5, 1.5), (2.5, 3.5)]),
+        box(1.0, 3.0, 1.2, 3.6),
+    ]
+    index = PolygonIndex([polygon.bounds for polygon in polygons])
+    assert index.query((0.5, 0.5, 2.5, 0.6)) == [0, 1]
+    assert index.query((5.0, 5.0, 6.0, 6.0)) == []
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
@@ -3,70 +3,566 @@
 
 import os
 import sys
+import csv
 import json
-from .geohash import encode
+import mmap
+import threading
+from collections import OrderedDict
+from .geohash import encode, encode_int_array, geohash2int
 
-# get_area_from_json_db():
-def get_area_from_json_db(lat, lng, gh2ac_path, ac2an_path):
+# the prefix of the area codes of boundary cells (hybrid mode),
+# same as boundary.BOUNDARY_PREFIX.
+BOUNDARY_PREFIX = '@'
+
+# ReverseGeocoder
+#   keeps geohash2areacode and areacode2name resident
+#   so that each lookup is a prefix walk over in-memory tables.
+class ReverseGeocoder(object):
+
+    # ReverseGeocoder(gh2ac, ac2an, n_chars, levels, boundary)
+    # - gh2ac: geohash -> area_code (anything that has get()).
+    # - ac2an: area_code -> area_name (anything that has get()).
+    # - levels: (depth, {prefix: (length,...)}) by load_levels().
+    # - boundary: BoundaryReader by load_boundary().
+    def __init__(self, gh2ac, ac2an, n_chars=7, levels=None, boundary=None):
+        self.gh2ac = gh2ac
+        self.ac2an = ac2an
+        self.n_chars = n_chars
+        self.levels = levels
+        self.boundary = boundary
+        self._sorted_index = None
+        self._areacode2index = None
+        self._boundary_indexes = None
+        self._index_lock = threading.Lock()
+        self.set_cache_size(0)
+        return
+
+    # set_cache_size(cache_size)
+    #   keeps the last cache_size resolved geohash prefixes (LRU)
+    #   so that the points in those cells don't touch the DB.
+    #   cache_size = 0 disables the cache.
+    def set_cache_size(self, cache_size):
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self._cache = OrderedDict() if 0 < cache_size else None
+        self._cache_lock = threading.Lock()
+        return
+
+    # after_fork()
+    #   called in a forked child process: the cache and its lock
+    #   are not shared with the parent (the DB itself is shared).
+    def after_fork(self):
+        self.set_cache_size(self.cache_size)
+        return
+
+    # get_cache_stats() -> {'hits': n, 'misses': n, ...} or None
+    def get_cache_stats(self):
+        if self._cache is None:
+            return None
+        return {
+            'size': len(self._cache),
+            'max_size': self.cache_size,
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions
+        }
+
+    # find(geohash) -> (geohash_prefix, area_code) or None
+    def find(self, geohash):
+        cache = self._cache
+        if cache is None:
+            return self.find_db(geohash)
+        with self._cache_lock:
+            for length in range(len(geohash), 0, -1):
+                area_code = cache.get(geohash[:length])
+                if area_code is not None:
+                    cache.move_to_end(geohash[:length])
+                    self.cache_hits += 1
+                    return (geohash[:length], area_code)
+            self.cache_misses += 1
+        found = self.find_db(geohash)
+        if found is not None:
+            with self._cache_lock:
+                (prefix, area_code) = found
+                cache[prefix] = area_code
+                if self.cache_size < len(cache):
+                    cache.popitem(last=False)
+                    self.cache_evictions += 1
+        return found
+
+    # find_db(geohash) -> (geohash_prefix, area_code) or None
+    def find_db(self, geohash):
+        if self.levels is not None and self.levels[0] <= len(geohash):
+            # probe only the lengths in the level index.
+            (depth, prefix2lengths) = self.levels
+            for length in prefix2lengths.get(geohash[:depth], ()):
+                if len(geohash) < length:
+                    continue
+                area_code = self.gh2ac.get(geohash[:length])
+                if area_code is not None:
+                    return (geohash[:length], area_code)
+            return None
+        gh1 = geohash
+        while 0 < len(gh1):
+            area_code = self.gh2ac.get(gh1)
+            if area_code is not None:
+                return (gh1, area_code)
+            gh1 = gh1[:-1]
+        return None
+
+    # resolve_area_code(area_code, lat, lng)
+    #   the area code of a boundary cell (hybrid mode)
+    #   -> the area code of the polygon which contains (lat, lng),
+    #      or the default area code of the cell.
+    def resolve_area_code(self, area_code, lat, lng):
+        if not area_code.startswith(BOUNDARY_PREFIX):
+            return area_code
+        if self.boundary is not None:
+            boundary = self.boundary
+            found = boundary.locate(
+                encode(lat, lng, boundary.n_chars), lat, lng)
+            if found is not None:
+                return found
+        return area_code[len(BOUNDARY_PREFIX):]
+
+    # get_area_code(lat, lng)
+    def get_area_code(self, lat, lng):
+        found = self.find(encode(lat, lng, self.n_chars))
+        if found is None:
+            return None
+        (_, area_code) = found
+        return self.resolve_area_code(area_code, lat, lng)
+
+    # get_area_name(area_code)
+    def get_area_name(self, area_code):
+        return self.ac2an.get(area_code)
+
+    # get_area(lat, lng)
+    def get_area(self, lat, lng):
+        area_code = self.get_area_code(lat, lng)
+        if area_code is None:
+            return None
+        return self.get_area_name(area_code)
+
+    # get_sorted_index()
+    #   -> (area_codes, [(length, sorted_geohashes, area_code_indexes),...])
+    #   geohashes are grouped by length (longest first)
+    #   and stored as sorted integers (numpy arrays).
+    def get_sorted_index(self):
+        import numpy as np
+        if self._sorted_index is not None:
+            return self._sorted_index
+        area_codes = []
+        areacode2index = {}
+        length2entries = {}
+        for (geohash, area_code) in self.gh2ac.items():
+            if self.n_chars < len(geohash):
+                continue
+            i = areacode2index.get(area_code)
+            if i is None:
+                i = areacode2index[area_code] = len(area_codes)
+                area_codes.append(area_code)
+            entries = length2entries.setdefault(len(geohash), ([], []))
+            entries[0].append(geohash2int(geohash))
+            entries[1].append(i)
+        levels = []
+        for length in sorted(length2entries.keys(), reverse=True):
+            (geohashes, indexes) = length2entries[length]
+            geohashes = np.array(geohashes, dtype=np.uint64)
+            indexes = np.array(indexes, dtype=np.int32)
+            order = np.argsort(geohashes)
+            levels.append((length, geohashes[order], indexes[order]))
+        self._sorted_index = (area_codes, levels)
+        return self._sorted_index
+
+    # lookup_indexes(lats, lngs)
+    #   -> indexes into area_codes of get_sorted_index() (-1: not found).
+    def lookup_indexes(self, lats, lngs):
+        import numpy as np
+        (_, levels) = self.get_sorted_index()
+        geohashes = encode_int_array(lats, lngs, self.n_chars)
+        indexes = np.full(len(geohashes), -1, dtype=np.int32)
+        for (length, geohashes1, indexes1) in levels:
+            unresolved = np.nonzero(indexes < 0)[0]
+            if len(unresolved) == 0:
+                break
+            prefixes = geohashes[unresolved] >> np.uint64(
+                5 * (self.n_chars - length))
+            i = np.searchsorted(geohashes1, prefixes)
+            i[i == len(geohashes1)] = 0
+            found = (geohashes1[i] == prefixes)
+            indexes[unresolved[found]] = indexes1[i[found]]
+        return self.resolve_indexes(indexes, lats, lngs)
+
+    # resolve_indexes(indexes, lats, lngs)
+    #   the indexes of boundary cells (hybrid mode)
+    #   -> the indexes of the resolved area codes.
+    #   area codes which are found only in the boundary cells
+    #   are appended to area_codes of get_sorted_index().
+    def resolve_indexes(self, indexes, lats, lngs):
+        import numpy as np
+        (area_codes, _) = self.get_sorted_index()
+        with self._index_lock:
+            if self._areacode2index is None:
+                self._areacode2index = dict(
+                    (area_code, i) for (i, area_code) in enumerate(area_codes))
+                self._boundary_indexes = [
+                    i for (i, area_code) in enumerate(area_codes)
+                    if area_code.startswith(BOUNDARY_PREFIX)]
+        boundary_indexes = self._boundary_indexes
+        if len(boundary_indexes) == 0:
+            return indexes
+        for j in np.nonzero(np.isin(indexes, boundary_indexes))[0].tolist():
+            area_code = self.resolve_area_code(
+                area_codes[indexes[j]], float(lats[j]), float(lngs[j]))
+            with self._index_lock:
+                i = self._areacode2index.get(area_code)
+                if i is None:
+                    i = self._areacode2index[area_code] = len(area_codes)
+                    area_codes.append(area_code)
+            indexes[j] = i
+        return indexes
+
+    # get_area_codes(lats, lngs)
+    #   batch version of get_area_code().
+    #   -> numpy array of area codes (None: not found).
+    def get_area_codes(self, lats, lngs):
+        import numpy as np
+        indexes = self.lookup_indexes(lats, lngs)
+        (area_codes, _) = self.get_sorted_index()
+        table = np.array(area_codes + [None], dtype=object)
+        return table[indexes]
+
+    # get_areas(lats, lngs)
+    #   batch version of get_area().
+    #   -> numpy array of area names (None: not found).
+    def get_areas(self, lats, lngs):
+        import numpy as np
+        indexes = self.lookup_indexes(lats, lngs)
+        (area_codes, _) = self.get_sorted_index()
+        table = np.array([
+            self.get_area_name(area_code) for area_code in area_codes
+        ] + [None], dtype=object)
+        return table[indexes]
+
+# BinGeocoder
+#   ReverseGeocoder over a bin DB (BinDBReader),
+#   which finds the longest prefix by one binary search.
+class BinGeocoder(ReverseGeocoder):
+
+    # BinGeocoder(reader, n_chars, boundary)
+    def __init__(self, reader, n_chars=7, boundary=None):
+        ReverseGeocoder.__init__(
+            self, reader, reader.ac2an, n_chars, boundary=boundary)
+        return
+
+    # find_db(geohash) -> (geohash_prefix, area_code) or None
+    def find_db(self, geohash):
+        return self.gh2ac.find(geohash)
+
+    # get_sorted_index()
+    #   built from the sorted keys of the bin DB directly.
+    def get_sorted_index(self):
+        import numpy as np
+        from .bindb import MAX_CHARS
+        if self._sorted_index is not None:
+            return self._sorted_index
+        keys = np.asarray(self.gh2ac.keys, dtype=np.uint64)
+        values = np.asarray(self.gh2ac.values, dtype=np.int32)
+        lengths = (keys & np.uint64(0b1111)).astype(np.int32)
+        levels = []
+        for length in sorted(set(lengths.tolist()), reverse=True):
+            if self.n_chars < length:
+                continue
+            selected = (lengths == length)
+            # keys are already sorted within the same length.
+            geohashes = keys[selected] >> np.uint64(
+                4 + 5 * (MAX_CHARS - length))
+            levels.append((length, geohashes, values[selected]))
+        self._sorted_index = (list(self.gh2ac.area_codes), levels)
+        return self._sorted_index
+
+# the default geohash length of DBs without the spec.
+DEFAULT_N_CHARS = 7
+
+# load_n_chars():
+#   reads the geohash length of the DB from the spec next to gh2ac_path
+#   (written by make_db()).
+#   e.g. geohash2areacode.cdb -> geohash2areacode.spec.json
+#   -> n_chars (DEFAULT_N_CHARS if no spec)
+def load_n_chars(gh2ac_path):
+    spec_path = os.path.splitext(gh2ac_path)[0] + '.spec.json'
+    if not os.path.isfile(spec_path):
+        return DEFAULT_N_CHARS
+    with open(spec_path, 'r') as fp:
+        return json.load(fp)['n_chars']
+
+# load_levels():
+#   reads the level index next to gh2ac_path (if any).
+#   e.g. geohash2areacode.cdb -> geohash2areacode.levels.json
+#   -> (depth, {prefix: (length,...)}) (longest first) or None
+def load_levels(gh2ac_path):
+    levels_path = os.path.splitext(gh2ac_path)[0] + '.levels.json'
+    if not os.path.isfile(levels_path):
+        return None
+    with open(levels_path, 'r') as fp:
+        levels = json.load(fp)
+    mask2lengths = {}
+    prefix2lengths = {}
+    for (prefix, mask) in levels['levels'].items():
+        lengths = mask2lengths.get(mask)
+        if lengths is None:
+            lengths = tuple(
+                n for n in range(mask.bit_length() - 1, 0, -1) if mask >> n & 1)
+            mask2lengths[mask] = lengths
+        prefix2lengths[prefix] = lengths
+    return (levels['depth'], prefix2lengths)
+
+# load_boundary():
+#   opens the boundary file next to gh2ac_path (if any).
+#   e.g. geohash2areacode.cdb -> geohash2areacode.boundary
+#   -> BoundaryReader or None
+def load_boundary(gh2ac_path):
+    boundary_path = os.path.splitext(gh2ac_path)[0] + '.boundary'
+    if not os.path.isfile(boundary_path):
+        return None
+    from .boundary import boundary_open
+    return boundary_open(boundary_path)
+
+# open_json_db():
+#   n_chars: the geohash length of the DB (None: by load_n_chars()).
+def open_json_db(gh2ac_path, ac2an_path, n_chars=None):
     if not os.path.isfile(gh2ac_path) or not os.path.isfile(ac2an_path):
         raise ValueError()
-    # gh2ac
-    area_code = None
-    gh2ac = {}
+    if n_chars is None:
+        n_chars = load_n_chars(gh2ac_path)
     with open(gh2ac_path, 'r') as fp:
         gh2ac = json.load(fp)
-    gh1 = encode(lat, lng, 7)
-    while 0 < len(gh1):
-        if gh1 in gh2ac:
-            area_code = gh2ac[gh1]
-            break;
-        gh1 = gh1[:-1]
-    del gh2ac
-    # ac2an
-    if area_code is not None:
-        ac2an = {}
-        with open(ac2an_path, 'r') as fp:
-            ac2an = json.load(fp)
-        if area_code in ac2an:
-            return ac2an[area_code]
-    return None
+    with open(ac2an_path, 'r') as fp:
+        ac2an = json.load(fp)
+    return ReverseGeocoder(gh2ac, ac2an, n_chars, load_levels(gh2ac_path),
+        load_boundary(gh2ac_path))
 
-# get_area_from_cdb():
-def get_area_from_cdb(lat, lng, gh2ac_path, ac2an_path):
-    from .cdb import cdbget
+# open_cdb():
+#   gh2ac_path may be a cdb64 file (*.cdb64).
+def open_cdb(gh2ac_path, ac2an_path, n_chars=None):
+    from .cdb import cdbopen
     if not os.path.isfile(gh2ac_path) or not os.path.isfile(ac2an_path):
         raise ValueError()
-    # gh2ac
-    area_code = None
-    gh1 = encode(lat, lng, 7)
-    while 0 < len(gh1):
-        try:
-            area_code = cdbget(gh2ac_path, gh1)
-            break
-        except KeyError:
-            pass
-        gh1 = gh1[:-1]
-    # ac2an
-    if area_code is not None:
-        try:
-            area_name = cdbget(ac2an_path, area_code)
-            return area_name
-        except KeyError:
-            pass
-    return None
+    if n_chars is None:
+        n_chars = load_n_chars(gh2ac_path)
+    return ReverseGeocoder(cdbopen(gh2ac_path), cdbopen(ac2an_path), n_chars,
+        load_levels(gh2ac_path), load_boundary(gh2ac_path))
 
-# get_area_from_fs_db():
-def get_area_from_fs_db(lat, lng, gh2ac_path, ac2an_path):
+# open_bin_db():
+def open_bin_db(bin_path, n_chars=None):
+    from .bindb import bindb_open
+    if not os.path.isfile(bin_path):
+        raise ValueError()
+    if n_chars is None:
+        n_chars = load_n_chars(bin_path)
+    return BinGeocoder(bindb_open(bin_path), n_chars,
+        load_boundary(bin_path))
+
+# FSDB
+#   geohash -> area_code over the sharded file structure
+#   made by make_areacode_directories(); a shard is mmapped at its first use
+#   and its lines (sorted by geohash) are looked up by bisection.
+class FSDB(object):
+
+    # FSDB(dir_path)
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        with open(os.path.join(dir_path, '_shard'), 'r') as fp:
+            self.shard_depth = int(fp.read())
+        self._shards = {}
+        return
+
+    # get_shard(prefix) -> mmap (None if the shard is missing or empty)
+    def get_shard(self, prefix):
+        if prefix not in self._shards:
+            mm = None
+            fpath = os.path.join(self.dir_path, prefix)
+            if os.path.isfile(fpath) and 0 < os.path.getsize(fpath):
+                with open(fpath, 'rb') as fp:
+                    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._shards[prefix] = mm
+        return self._shards[prefix]
+
+    # get(geohash, default)
+    def get(self, k, default=None):
+        if len(k) < self.shard_depth:
+            return default
+        mm = self.get_shard(k[:self.shard_depth])
+        if mm is None:
+            return default
+        key = k.encode()
+        # lo and hi are always at the start of a line.
+        (lo, hi) = (0, len(mm))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', 0, mid) + 1
+            end = mm.find(b'\n', mid)
+            tab = mm.find(b'\t', start, end)
+            geohash = mm[start:tab]
+            if geohash == key:
+                return mm[tab+1:end].decode()
+            elif geohash < key:
+                lo = end + 1
+            else:
+                hi = start
+        return default
+
+    # items()
+    def items(self):
+        for prefix in sorted(os.listdir(self.dir_path)):
+            if prefix.startswith('_'):
+                continue
+            with open(os.path.join(self.dir_path, prefix), 'r') as fp:
+                for line in fp:
+                    (geohash, area_code) = line.rstrip('\n').split('\t')
+                    yield (geohash, area_code)
+        return
+
+# FSAreaNames
+#   area_code -> area_name over areacode2name directory.
+class FSAreaNames(object):
+
+    # FSAreaNames(dir_path)
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self._names = {}
+        return
+
+    # get(area_code, default)
+    def get(self, k, default=None):
+        if k not in self._names:
+            fpath = os.path.join(self.dir_path, k)
+            self._names[k] = None
+            if os.path.isfile(fpath):
+                with open(fpath, 'r') as fp:
+                    self._names[k] = fp.read()
+        v = self._names[k]
+        return default if v is None else v
+
+# open_fs_db():
+def open_fs_db(gh2ac_path, ac2an_path, n_chars=None):
     if not os.path.isdir(gh2ac_path) or not os.path.isdir(ac2an_path):
         raise ValueError()
-    gh1 = encode(lat, lng, 7)
-    while 0 < len(gh1):
-        fpath1 = os.path.join(gh2ac, os.path.sep.join(gh1))
-        if os.path.isfile(fpath1):
-            with open(fpath1) as fp:
-                return fp.read()
-        gh1 = gh1[:-1]
-    return None
+    if n_chars is None:
+        n_chars = load_n_chars(gh2ac_path)
+    return ReverseGeocoder(FSDB(gh2ac_path), FSAreaNames(ac2an_path),
+        n_chars, load_levels(gh2ac_path), load_boundary(gh2ac_path))
+
+# get_geocoder():
+#   returns the geocoder opened by open_db_func(*paths),
+#   which is opened only once per process.
+#   the geocoder has an LRU cache of _cache_size (set_cache_size()).
+_geocoders = {}
+_cache_size = 0
+def get_geocoder(open_db_func, *paths):
+    key = (open_db_func.__name__,) + paths
+    geocoder = _geocoders.get(key)
+    if geocoder is None:
+        geocoder = open_db_func(*paths)
+        geocoder.set_cache_size(_cache_size)
+        _geocoders[key] = geocoder
+    return geocoder
+
+# set_cache_size():
+#   the cache size of the geocoders by get_geocoder().
+def set_cache_size(cache_size):
+    global _cache_size
+    _cache_size = cache_size
+    for geocoder in _geocoders.values():
+        geocoder.set_cache_size(cache_size)
+    return
+
+# get_cache_stats():
+#   -> [stats of the cache of each geocoder by get_geocoder(),...]
+def get_cache_stats():
+    return [geocoder.get_cache_stats() for geocoder in _geocoders.values()]
+
+# _after_fork():
+#   the geocoders by get_geocoder() are reused by forked processes
+#   (mmapped DBs are shared, not copied).
+def _after_fork():
+    for geocoder in _geocoders.values():
+        geocoder.after_fork()
+    return
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+# geocode_csv():
+#   read (lat, lng, ...) rows from src_path
+#   and write (lat, lng, ..., area_code, area_name) rows to dst_path,
+#   chunk_size rows at a time.
+def geocode_csv(geocoder, src_path, dst_path, chunk_size=100000):
+    import numpy as np
+    # write_chunk()
+    def write_chunk(writer, rows):
+        lats = np.array([float(row[0]) for row in rows])
+        lngs = np.array([float(row[1]) for row in rows])
+        indexes = geocoder.lookup_indexes(lats, lngs)
+        # area codes resolved in boundary cells (hybrid mode).
+        for area_code in area_codes[len(area_names):]:
+            area_names.append(geocoder.get_area_name(area_code) or '')
+        for (row, i) in zip(rows, indexes):
+            if 0 <= i:
+                writer.writerow(row + [area_codes[i], area_names[i]])
+            else:
+                writer.writerow(row + ['', ''])
+        return
+    (area_codes, _) = geocoder.get_sorted_index()
+    area_names = [
+        geocoder.get_area_name(area_code) or '' for area_code in area_codes]
+    n_rows = 0
+    with open(src_path, 'r', newline='') as fsrc, \
+        open(dst_path, 'w', newline='') as fdst:
+        reader = csv.reader(fsrc)
+        writer = csv.writer(fdst)
+        rows = []
+        for (i_row, row) in enumerate(reader):
+            if len(row) < 2:
+                continue
+            if i_row == 0:
+                try:
+                    float(row[0])
+                except ValueError:
+                    # header
+                    writer.writerow(row + ['area_code', 'area_name'])
+                    continue
+            rows.append(row)
+            if chunk_size <= len(rows):
+                write_chunk(writer, rows)
+                n_rows += len(rows)
+                rows = []
+        if 0 < len(rows):
+            write_chunk(writer, rows)
+            n_rows += len(rows)
+    return n_rows
+
+# get_area_from_json_db():
+def get_area_from_json_db(lat, lng, gh2ac_path, ac2an_path):
+    geocoder = get_geocoder(open_json_db, gh2ac_path, ac2an_path)
+    return geocoder.get_area(lat, lng)
+
+# get_area_from_cdb():
+def get_area_from_cdb(lat, lng, gh2ac_path, ac2an_path):
+    geocoder = get_geocoder(open_cdb, gh2ac_path, ac2an_path)
+    return geocoder.get_area(lat, lng)
+
+# get_area_from_bin_db():
+def get_area_from_bin_db(lat, lng, bin_path):
+    geocoder = get_geocoder(open_bin_db, bin_path)
+    return geocoder.get_area(lat, lng)
+
+# get_area_from_fs_db():
+def get_area_from_fs_db(lat, lng, gh2ac_path, ac2an_path):
+    geocoder = get_geocoder(open_fs_db, gh2ac_path, ac2an_path)
+    return geocoder.get_area(lat, lng)
 
 # main():
 def main(args):
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# records.py - append-only binary record streams of (key, val)
+# [Format]
+# - record: klen(H), vlen(H), key, val (little endian, utf-8)
+# Workers of make_db write (geohash, area_code) records of each root
+# to a stream, and the DB writers read them without parsing json.
+
+import sys
+import os
+from struct import pack, unpack_from
+from itertools import chain
+
+# RecordWriter
+class RecordWriter(object):
+
+    BUFFER_SIZE = 1 << 20
+
+    # RecordWriter(name)
+    def __init__(self, name):
+        self.fn = name
+        self.fntmp = name+'.tmp'
+        self.numentries = 0
+        self._fp = open(self.fntmp, 'wb', buffering=self.BUFFER_SIZE)
+        return
+
+    # add(key, val)
+    def add(self, k, v):
+        return self.add_many([(k, v)])
+
+    # add_many(iterable of (key, val))
+    def add_many(self, items):
+        records = []
+        for (k, v) in items:
+            k = k.encode()
+            v = v.encode()
+            records.append(pack('<HH', len(k), len(v)))
+            records.append(k)
+            records.append(v)
+        self._fp.write(b''.join(records))
+        self.numentries += len(records) // 3
+        return self
+
+    # finish()
+    def finish(self):
+        self._fp.close()
+        os.rename(self.fntmp, self.fn)
+        return
+
+# recmake(name)
+def recmake(name):
+    return RecordWriter(name)
+
+# read_records(name)
+#   iterate over all (key, val) in the order they were added.
+#   a stream is read at once (a stream is as large as a root).
+def read_records(name):
+    with open(name, 'rb') as fp:
+        data = fp.read()
+    pos = 0
+    while pos < len(data):
+        (klen, vlen) = unpack_from('<HH', data, pos)
+        pos += 4
+        k = data[pos:pos+klen].decode()
+        pos += klen
+        v = data[pos:pos+vlen].decode()
+        pos += vlen
+        yield (k, v)
+    return
+
+# read_records_many(names)
+def read_records_many(names):
+    return chain.from_iterable(read_records(name) for name in names)
+
+# count_records(name) -> the number of records
+#   only the headers are read (keys and values are skipped).
+def count_records(name):
+    with open(name, 'rb') as fp:
+        data = fp.read()
+    n = 0
+    pos = 0
+    while pos < len(data):
+        (klen, vlen) = unpack_from('<HH', data, pos)
+        pos += 4 + klen + vlen
+        n += 1
+    return n
+
+# test()
+def test():
+    d = {
+        'xn76urx': '13101',
+        'xn76': '13102',
+        'w': '東京都'
+    }
+    writer = recmake('myrec.rec')
+    writer.add('xn7', '13103')
+    writer.add_many(d.items())
+    writer.finish()
+    assert writer.numentries == len(d) + 1
+    assert list(read_records('myrec.rec')) == [('xn7', '13103')] + list(
+        d.items())
+    recmake('myrec2.rec').finish()
+    assert list(read_records('myrec2.rec')) == []
+    assert len(list(read_records_many(['myrec.rec', 'myrec2.rec']))) == 4
+    assert count_records('myrec.rec') == writer.numentries
+    assert count_records('myrec2.rec') == 0
+    os.remove('myrec.rec')
+    os.remove('myrec2.rec')
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# resolve.py - resolution of boundary cells with several candidate areas.
+# Each candidate is clipped by the cell, and the area code of a cell is
+# the area of the largest intersection with the cell
+# (ties are broken by the distance from the center of the cell,
+#  and then by the area code, so that the result doesn't depend on
+#  the order of candidates).
+# Candidates which only touch the cell (no intersection area) are dropped.
+# All the cells of a root are clipped in one batch
+# (vectorized with shapely 2.x if available).
+
+import sys
+import shapely
+from shapely.geometry import Point, box
+from .geohash import decode_to_bounds
+from .polyindex import SHAPELY_2
+
+# clip_candidates(pairs) -> [clipped,...]
+#   pairs: [(geohash, polygon),...]
+def clip_candidates(pairs):
+    geohash2bounds = {}
+    bounds = []
+    for (geohash, _) in pairs:
+        if geohash not in geohash2bounds:
+            geohash2bounds[geohash] = decode_to_bounds(geohash)
+        bounds.append(geohash2bounds[geohash])
+    if SHAPELY_2:
+        import numpy as np
+        a = np.array(bounds)
+        boxes = shapely.box(a[:, 0], a[:, 1], a[:, 2], a[:, 3])
+        polygons = np.empty(len(pairs), dtype=object)
+        polygons[:] = [polygon for (_, polygon) in pairs]
+        return list(shapely.intersection(polygons, boxes))
+    return [
+        polygon.intersection(box(*bounds1))
+        for ((_, polygon), bounds1) in zip(pairs, bounds)]
+
+# get_center(geohash) -> Point
+def get_center(geohash):
+    (minlat, minlng, maxlat, maxlng) = decode_to_bounds(geohash)
+    return Point((minlat + maxlat) / 2, (minlng + maxlng) / 2)
+
+# resolve_candidates(geohash2candidates)
+#   geohash2candidates: {geohash: [(polygon, area_code),...]}
+#   -> ({geohash: (area_code, [(area_code, clipped),...])}, n_ambiguous)
+#   clipped: the intersections of the areas with the cell
+#            (only for the cells of several areas).
+#   n_ambiguous: the number of cells of several areas.
+def resolve_candidates(geohash2candidates):
+    retval = {}
+    pairs = []
+    area_codes = []
+    for (geohash, candidates) in geohash2candidates.items():
+        assert(0 < len(candidates))
+        if len(set(area_code for (_, area_code) in candidates)) == 1:
+            (_, area_code) = candidates[0]
+            retval[geohash] = (area_code, [])
+            continue
+        for (polygon, area_code) in candidates:
+            pairs.append((geohash, polygon))
+            area_codes.append(area_code)
+    if len(pairs) == 0:
+        return (retval, 0)
+    # geohash -> {area_code: (area, [clipped,...])}
+    geohash2areas = {}
+    for ((geohash, polygon), area_code, clipped) in zip(
+        pairs, area_codes, clip_candidates(pairs)):
+        areas = geohash2areas.setdefault(geohash, {})
+        (area, parts) = areas.get(area_code, (0.0, []))
+        if 0 < clipped.area:
+            area += clipped.area
+            parts.append(clipped)
+        areas[area_code] = (area, parts)
+    n_ambiguous = 0
+    for (geohash, areas) in geohash2areas.items():
+        scores = sorted(
+            ((-area, area_code) for (area_code, (area, _)) in areas.items()))
+        best = scores[0]
+        ties = [area_code for (score, area_code) in scores if score == best[0]]
+        if 1 < len(ties):
+            # the nearest to the center of the cell.
+            center = get_center(geohash)
+            geohash2candidates1 = geohash2candidates[geohash]
+            distances = {}
+            for (polygon, area_code) in geohash2candidates1:
+                if area_code in ties:
+                    d = polygon.distance(center)
+                    distances[area_code] = min(
+                        d, distances.get(area_code, d))
+            ties.sort(key=lambda area_code: (distances[area_code], area_code))
+        clipped = [
+            (area_code, part)
+            for (area_code, (area, parts)) in sorted(areas.items())
+            for part in parts]
+        if 1 < len(set(area_code for (area_code, _) in clipped)):
+            n_ambiguous += 1
+        else:
+            clipped = []
+        retval[geohash] = (ties[0], clipped)
+    return (retval, n_ambiguous)
+
+# test()
+def test():
+    # xn76u is split by the line of lat = 35.68 (nearly 1/3 north).
+    (minlat, minlng, maxlat, maxlng) = decode_to_bounds('xn76u')
+    south = box(35.0, 139.0, 35.68, 140.0)
+    north = box(35.68, 139.0, 36.0, 140.0)
+    touching = box(minlat - 1.0, minlng, minlat, maxlng)
+    (result, n_ambiguous) = resolve_candidates({
+        'xn76u': [(north, '13102'), (south, '13101'), (touching, '13103')],
+        'xn76g': [(north, '13102')]
+    })
+    assert n_ambiguous == 1
+    assert result['xn76g'] == ('13102', [])
+    (area_code, clipped) = result['xn76u']
+    assert area_code == '13101'
+    assert sorted(set(area_code for (area_code, _) in clipped)) == [
+        '13101', '13102']
+    # the order of candidates doesn't matter.
+    (result, _) = resolve_candidates({
+        'xn76u': [(touching, '13103'), (south, '13101'), (north, '13102')]
+    })
+    assert result['xn76u'][0] == '13101'
+    # only touching: the nearest to the center.
+    (result, n_ambiguous) = resolve_candidates({
+        'xn76u': [(touching, '13103'),
+            (box(minlat, maxlng, maxlat, maxlng + 1.0), '13104')]
+    })
+    assert n_ambiguous == 0
+    assert result['xn76u'][0] in ('13103', '13104')
+    assert result['xn76u'][1] == []
+    # equal areas: the nearest to the center, and then the area code.
+    (result, _) = resolve_candidates({
+        'xn76u': [(box(minlat, minlng, maxlat, maxlng), '13106'),
+            (box(minlat, minlng, maxlat, maxlng), '13105')]
+    })
+    assert result['xn76u'][0] == '13105'
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
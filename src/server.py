@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# server.py - HTTP server of reverse geocoding over query_db
+# [API]
+# - GET /?lat=35.68123&lng=139.76712
+#   -> {"lat": 35.68123, "lng": 139.76712,
+#       "area_code": "13101", "area_name": "東京都 千代田区"}
+# - GET /api/v1/35.68123+139.76712 (same as sample/back-end/index.php)
+# - POST / with [[lat, lng],...] (or {"points": [[lat, lng],...]})
+#   -> {"results": [{"lat": ..., "lng": ..., "area_code": ...,
+#       "area_name": ...},...]}
+# The geocoder (and its DB) is opened once and shared by all the threads.
+# In the prefork mode (serve_prefork()), the DB is opened before forking
+# the worker processes, so that they share the pages of the mmapped DB
+# (cdb or bin) instead of loading their own copies.
+
+import sys
+import os
+import gc
+import math
+import signal
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+# the maximum number of points in a POST request.
+MAX_POINTS = 100000
+# the maximum size of the body of a POST request
+#   (checked before the body is read).
+MAX_BODY = MAX_POINTS * 64
+
+# parse_point(lat, lng) -> (lat, lng)
+#   raises ValueError unless lat and lng are finite and in range
+#   (nan and inf can't be encoded to geohashes).
+def parse_point(lat, lng):
+    (lat, lng) = (float(lat), float(lng))
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        raise ValueError('lat and lng must be finite')
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        raise ValueError('lat or lng is out of range')
+    return (lat, lng)
+
+# lookup(geocoder, lat, lng) -> result (dict)
+def lookup(geocoder, lat, lng):
+    area_code = geocoder.get_area_code(lat, lng)
+    area_name = None
+    if area_code is not None:
+        area_name = geocoder.get_area_name(area_code)
+    return {
+        'lat': lat,
+        'lng': lng,
+        'area_code': area_code or '',
+        'area_name': area_name or ''
+    }
+
+# lookup_many(geocoder, points) -> [result,...]
+#   the points are looked up at once by get_area_codes()
+#   (one by one if numpy isn't available).
+def lookup_many(geocoder, points):
+    try:
+        import numpy as np
+    except ImportError:
+        return [lookup(geocoder, lat, lng) for (lat, lng) in points]
+    if len(points) == 0:
+        return []
+    lats = np.array([lat for (lat, _) in points])
+    lngs = np.array([lng for (_, lng) in points])
+    area_codes = geocoder.get_area_codes(lats, lngs)
+    areacode2name = {}
+    results = []
+    for ((lat, lng), area_code) in zip(points, area_codes):
+        area_name = None
+        if area_code is not None:
+            if area_code not in areacode2name:
+                areacode2name[area_code] = geocoder.get_area_name(area_code)
+            area_name = areacode2name[area_code]
+        results.append({
+            'lat': lat,
+            'lng': lng,
+            'area_code': area_code or '',
+            'area_name': area_name or ''
+        })
+    return results
+
+# GeocoderHandler
+class GeocoderHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # send_json(status, obj)
+    def send_json(self, status, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if self.close_connection:
+            # e.g. the body of the request is left unread.
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    # do_GET()
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            if url.path.startswith('/api/v1/'):
+                # /api/v1/lat+lng
+                s = unquote(url.path[len('/api/v1/'):]).replace(' ', '+')
+                (lat, lng) = parse_point(*s.split('+')[:2])
+            elif url.path == '/':
+                params = parse_qs(url.query)
+                (lat, lng) = parse_point(params['lat'][0], params['lng'][0])
+            else:
+                self.send_json(404, {'error': 'not found'})
+                return
+        except (KeyError, TypeError, ValueError):
+            self.send_json(400, {'error': 'valid lat and lng are required'})
+            return
+        self.send_json(200, lookup(self.server.geocoder, lat, lng))
+        return
+
+    # do_POST()
+    #   the body is read first, so that it isn't taken as the next request
+    #   on the keep-alive connection.
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self.close_connection = True
+            self.send_json(400, {'error': 'invalid Content-Length'})
+            return
+        if MAX_BODY < length:
+            # the body is left unread.
+            self.close_connection = True
+            self.send_json(413, {'error': 'request body too large'})
+            return
+        body = self.rfile.read(length)
+        if urlparse(self.path).path != '/':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            points = json.loads(body)
+            if isinstance(points, dict):
+                points = points['points']
+            if MAX_POINTS < len(points):
+                self.send_json(413, {'error': 'too many points'})
+                return
+            points = [parse_point(lat, lng) for (lat, lng) in points]
+        except (KeyError, TypeError, ValueError):
+            self.send_json(400, {'error': 'a list of [lat, lng] is required'})
+            return
+        self.send_json(200, {
+            'results': lookup_many(self.server.geocoder, points)
+        })
+        return
+
+    # log_message()
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+        return
+
+# GeocoderServer
+#   a thread per connection.
+class GeocoderServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    # GeocoderServer(address, geocoder, verbose)
+    def __init__(self, address, geocoder, verbose=False):
+        self.geocoder = geocoder
+        self.verbose = verbose
+        ThreadingHTTPServer.__init__(self, address, GeocoderHandler)
+        return
+
+# serve(geocoder, host, port)
+def serve(geocoder, host='127.0.0.1', port=8080, verbose=False):
+    server = GeocoderServer((host, port), geocoder, verbose)
+    print('Serving on http://%s:%d/' % (host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return
+
+# serve_prefork(geocoder, host, port, n_workers)
+#   the listening socket and the geocoder are made in the parent process,
+#   and n_workers processes accept connections on the socket.
+def serve_prefork(geocoder, host='127.0.0.1', port=8080, n_workers=2,
+    verbose=False):
+    if isinstance(geocoder.gh2ac, dict):
+        print('Warning: the DB is not mmapped (use cdb or bin);'
+            ' each worker copies the pages it touches.')
+    server = GeocoderServer((host, port), geocoder, verbose)
+    # objects made so far are never collected in the workers,
+    # so that gc doesn't write to (and copy) the shared pages.
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    # _terminate()
+    def _terminate(signum, frame):
+        raise KeyboardInterrupt
+    pids = []
+    for _ in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            # worker
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                geocoder.after_fork()
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                status = 1
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    # SIGTERM to the parent also terminates the workers.
+    signal.signal(signal.SIGTERM, _terminate)
+    print('Serving on http://%s:%d/ (%d workers)' % (
+        host, server.server_address[1], n_workers))
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+    server.server_close()
+    return
+
+# test()
+def test():
+    import threading
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    from .query_db import ReverseGeocoder
+    from .geohash import encode
+    gh = encode(35.68123, 139.76712, 5)
+    geocoder = ReverseGeocoder({gh: '13101'}, {'13101': 'Chiyoda'}, 7)
+    server = GeocoderServer(('127.0.0.1', 0), geocoder)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    with urlopen(url + '/?lat=35.68123&lng=139.76712') as fp:
+        result = json.loads(fp.read())
+        assert result['area_code'] == '13101'
+        assert result['area_name'] == 'Chiyoda'
+    with urlopen(url + '/api/v1/35.68123+139.76712') as fp:
+        assert json.loads(fp.read())['area_code'] == '13101'
+    request = Request(url + '/', json.dumps(
+        [[35.68123, 139.76712], [0.0, 0.0]]).encode(), method='POST')
+    with urlopen(request) as fp:
+        results = json.loads(fp.read())['results']
+        assert [r['area_code'] for r in results] == ['13101', '']
+    for query in ('/?lat=x', '/?lat=nan&lng=139.7', '/?lat=35.6&lng=inf',
+        '/api/v1/95.0+139.7'):
+        try:
+            urlopen(url + query)
+            assert False
+        except HTTPError as e:
+            assert e.code == 400
+    try:
+        urlopen(Request(url + '/', b'[[NaN, 139.7]]', method='POST'))
+        assert False
+    except HTTPError as e:
+        assert e.code == 400
+    request = Request(url + '/', b'[]', method='POST')
+    with urlopen(request) as fp:
+        assert json.loads(fp.read())['results'] == []
+    # the body of a POST to an unknown path isn't taken as a request.
+    import http.client
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    body = b'GET /nosuch HTTP/1.1\r\n\r\n'
+    conn.request('POST', '/nosuch', body)
+    response = conn.getresponse()
+    assert response.status == 404
+    response.read()
+    conn.request('GET', '/?lat=35.68123&lng=139.76712')
+    response = conn.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read())['area_code'] == '13101'
+    conn.close()
+    # a too large body is rejected before it's read.
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    conn.putrequest('POST', '/')
+    conn.putheader('Content-Length', str(MAX_BODY + 1))
+    conn.endheaders()
+    response = conn.getresponse()
+    assert response.status == 413
+    assert response.getheader('Connection') == 'close'
+    response.read()
+    conn.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# subdivide.py - recursive geohash subdivision of a polygon.
+# - INSIDE: the cell is contained in the polygon.
+# - BOUNDARY: the cell intersects with the boundary of the polygon
+#             at the finest level (n_geohash).
+# Cells are tested by their bounds first, and then
+# by exact predicates on the prepared polygon;
+# 32 sub-cells are classified in one batch
+# (vectorized with shapely 2.x if available).
+
+import sys
+import shapely
+from shapely.geometry import box
+from .geohash import BASE32, decode_int, geohash2int
+from .polyindex import SHAPELY_2
+if not SHAPELY_2:
+    from shapely.prepared import prep
+
+INSIDE = 1
+BOUNDARY = 2
+
+# get_sub_bounds()
+#   -> [(minlat, minlng, maxlat, maxlng),...] of 32 sub-geohashes.
+def get_sub_bounds(geohash):
+    n = geohash2int(geohash) << 5
+    n_chars = len(geohash) + 1
+    retval = []
+    for i in range(32):
+        ((minlat, maxlat), (minlng, maxlng)) = decode_int(n | i, n_chars)
+        retval.append((minlat, minlng, maxlat, maxlng))
+    return retval
+
+# Subdivider
+class Subdivider(object):
+
+    # Subdivider(polygon, n_geohash)
+    def __init__(self, polygon, n_geohash):
+        self.polygon = polygon
+        self.n_geohash = n_geohash
+        self.bounds = polygon.bounds
+        if SHAPELY_2:
+            shapely.prepare(polygon)
+            self._prepared = polygon
+        else:
+            self._prepared = prep(polygon)
+        return
+
+    # classify(cells) -> [(intersects, contains),...]
+    #   cells: [(minlat, minlng, maxlat, maxlng),...]
+    def classify(self, cells):
+        (minlat0, minlng0, maxlat0, maxlng0) = self.bounds
+        retval = [(False, False)] * len(cells)
+        # bounds test.
+        indexes = [
+            i for (i, (minlat1, minlng1, maxlat1, maxlng1)) in enumerate(cells)
+            if (minlat1 <= maxlat0 and minlat0 <= maxlat1 and
+                minlng1 <= maxlng0 and minlng0 <= maxlng1)]
+        if len(indexes) == 0:
+            return retval
+        # exact predicates.
+        if SHAPELY_2:
+            import numpy as np
+            a = np.array([cells[i] for i in indexes])
+            boxes = shapely.box(a[:, 0], a[:, 1], a[:, 2], a[:, 3])
+            intersects = shapely.intersects(self._prepared, boxes)
+            contains = np.zeros(len(indexes), dtype=bool)
+            contains[intersects] = shapely.contains(
+                self._prepared, boxes[intersects])
+            for (j, i) in enumerate(indexes):
+                retval[i] = (bool(intersects[j]), bool(contains[j]))
+        else:
+            for i in indexes:
+                cell = box(*cells[i])
+                if self._prepared.intersects(cell):
+                    retval[i] = (True, self._prepared.contains(cell))
+        return retval
+
+    # subdivide(geohash)
+    #   -> generates (geohash1, INSIDE|BOUNDARY) for sub-geohashes
+    #      of geohash (depth first).
+    def subdivide(self, geohash):
+        sub_bounds = get_sub_bounds(geohash)
+        for (char, (intersects, contains)) in zip(
+            BASE32, self.classify(sub_bounds)):
+            if not intersects:
+                # outside of polygon.
+                continue
+            geohash1 = geohash + char
+            if contains:
+                yield (geohash1, INSIDE)
+            elif len(geohash1) < self.n_geohash:
+                yield from self.subdivide(geohash1)
+            else:
+                yield (geohash1, BOUNDARY)
+        return
+
+# test()
+def test():
+    from .geohash import decode_to_bounds
+    # the polygon covers the 3/4 (lng) of xn7.
+    (minlat, minlng, maxlat, maxlng) = decode_to_bounds('xn7')
+    polygon = box(minlat, minlng, maxlat, (minlng + maxlng * 3) / 4)
+    subdivider = Subdivider(polygon, 4)
+    cells = dict(subdivider.subdivide('xn'))
+    assert cells.get('xn7') is None
+    assert 0 < len(cells)
+    assert all(geohash.startswith('xn') for geohash in cells)
+    assert set(cells.values()) <= set([INSIDE, BOUNDARY])
+    cells = dict(Subdivider(box(*decode_to_bounds('xn7')), 4).subdivide('xn'))
+    assert cells['xn7'] == INSIDE
+    assert all(not geohash.startswith('xn7') for geohash in cells
+        if geohash != 'xn7')
+    return
+
+if __name__ == '__main__':
+    sys.exit(test())